@@ -16,9 +16,13 @@ MIN_LENGTH = 500
 MIN_RATIO = 0.5
 PRECLUSTER_DIFFS = 4
 MIN_CLUSTER_SIZE = 3
+MAX_CONSENSUS_DEPTH = 0
+CONSENSUS_TIMEOUT = 0
 MIN_SNR = 3
 CLUSTER_METHODS = ('nearest', 'average', 'furthest')
 DEFAULT_METHOD = 'average'
+CONSENSUS_TOOLS = ('gcon.py', 'native')
+DEFAULT_CONSENSUS = 'gcon.py'
 
 args = argparse.Namespace()
 
@@ -89,6 +93,26 @@ def parse_args():
         metavar='INT',
         default=MIN_CLUSTER_SIZE,
         help='Minimum cluster to generate consensus sequences (%s)' % MIN_CLUSTER_SIZE)
+    add('--max_consensus_depth',
+        type=int,
+        metavar='INT',
+        default=MAX_CONSENSUS_DEPTH,
+        help='Build each cluster consensus from at most this many of its highest-QV reads, 0 for all (%s)' % MAX_CONSENSUS_DEPTH)
+    add('--consensus_timeout',
+        type=int,
+        metavar='SECONDS',
+        default=CONSENSUS_TIMEOUT,
+        help='Kill any Gcon.py job running longer than this, 0 for no limit (%s)' % CONSENSUS_TIMEOUT)
+    add('--consensus_max_cpu',
+        type=int,
+        metavar='SECONDS',
+        default=0,
+        help='CPU time limit for each Gcon.py job, 0 for no limit (0)')
+    add('--consensus_max_memory',
+        type=int,
+        metavar='MB',
+        default=0,
+        help='Memory limit for each Gcon.py job, 0 for no limit (0)')
     add('--clustering_method', 
         metavar='METHOD',
         dest='clusteringMethod', 
@@ -119,6 +143,11 @@ def parse_args():
         action='store_false',
         dest='enable_consensus',
         help="Turn off the iterative Clustering and Resequencing steps")
+    add('--consensus_tool',
+        metavar='TOOL',
+        default=DEFAULT_CONSENSUS,
+        choices=CONSENSUS_TOOLS,
+        help="Consensus backend, pbdagcon's gcon.py or the built-in 'native' engine (%s)" % DEFAULT_CONSENSUS)
     add('--blasr',
         metavar='BLASR_PATH', 
         help="Specify the path to the Blasr executable")
@@ -156,12 +185,17 @@ def parse_args():
         log.warn( msg )
         args.chimera_reference = args.alignment_reference
 
-    if args.enable_consensus and which( 'gcon.py' ) is None:
+    if args.enable_consensus and args.consensus_tool == 'gcon.py' \
+                             and which( 'gcon.py' ) is None:
         msg = 'No copies of pbdagcon/gcon.py detected in PATH, disabling consensus'
         log.warn( msg )
         args.enable_consensus = False
 
     # Validate numerical parameters
     validate_int( 'NumProc', args.nproc, minimum=0 )
+    validate_int( 'MaxConsensusDepth', args.max_consensus_depth, minimum=0 )
+    validate_int( 'ConsensusTimeout', args.consensus_timeout, minimum=0 )
+    validate_int( 'ConsensusMaxCpu', args.consensus_max_cpu, minimum=0 )
+    validate_int( 'ConsensusMaxMemory', args.consensus_max_memory, minimum=0 )
     validate_float( 'Distance', args.distance, minimum=MIN_DIST, 
                                                maximum=MAX_DIST )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 __author__ = 'etseng@pacificbiosciences.com'
-import os, sys, shutil, subprocess, multiprocessing
+import os, sys, glob, bisect, shutil, subprocess, multiprocessing
+from cStringIO import StringIO
 from Bio import SeqIO
 from collections import defaultdict, namedtuple
 
@@ -16,6 +17,11 @@ Steps for running HMMER to identify & trim away barcodes
 
 DOMRecord = namedtuple("DOMRecord", "pStart pEnd sStart sEnd score")
 
+SPLITS_PER_CPU = 4
+MIN_SPLIT_BASES = 100000
+COPY_BUFFER = 16 * 1024 * 1024
+REPORT_HEADER = "ID\tstrand\t5seen\tpolyAseen\t3seen\t5end\tpolyAend\t3end\tprimer\n"
+
 def polyA_finder(seq, isA, min_len=8, p3_start=None):
     """
     isA --- if True, look for polyA on 3'; else look for polyT on 5'
@@ -167,9 +173,20 @@ def pick_best_primer_combo(d_front, d_back, primer_indices, min_score):
 def trim_barcode(primer_indices, fasta_filename, output_filename, d_fw, d_rc, k, see_left, see_right, min_seqlen, min_score, output_anyway=False, change_seqid=False):
     fout = open(output_filename, 'w')
     freport = open(output_filename + '.primer_info.txt', 'w')
-    freport.write("ID\tstrand\t5seen\tpolyAseen\t3seen\t5end\tpolyAend\t3end\tprimer\n")
+    freport.write(REPORT_HEADER)
+
+    records = SeqIO.parse(open(fasta_filename), 'fasta')
+    trim_records(primer_indices, records, fout, freport, d_fw, d_rc, k, see_left, see_right, min_seqlen, min_score, output_anyway, change_seqid)
+
+    fout.close()
+    freport.close()
 
-    for r in SeqIO.parse(open(fasta_filename), 'fasta'):
+def trim_records(primer_indices, records, fout, freport, d_fw, d_rc, k, see_left, see_right, min_seqlen, min_score, output_anyway=False, change_seqid=False):
+    """
+    Trim the primers from each record, writing the trimmed sequences to fout
+    and a line per record to freport (without the report header)
+    """
+    for r in records:
         ind, strand, fw, rc = pick_best_primer_combo(d_fw[r.id], d_rc[r.id], primer_indices, min_score)
         if fw is None and rc is None: # no match to either fw/rc primer on any end!
             # write the report
@@ -239,14 +256,136 @@ def trim_barcode(primer_indices, fasta_filename, output_filename, d_fw, d_rc, k,
                 e3 = 'NA' if p3_start is None else p3_start,\
                 pm=ind))
 
-    fout.close()
-    freport.close()
-
 def worker(out_filename_hmmer, p_filename, in_filename, matrix_filename):
     cmd = "phmmer --domtblout {0} --noali --domE 1 --mxfile {3} --popen 0.07 --pextend 0.07 {2} {1} > /dev/null".format(out_filename_hmmer, p_filename, in_filename, matrix_filename)
     print >> sys.stderr, "CMD:", cmd
     subprocess.check_call(cmd, shell=True)
 
+def split_worker(args):
+    """
+    Pool-friendly wrapper around worker, returning the index of the split
+    """
+    i, out_filename_hmmer, p_filename, in_filename, matrix_filename = args
+    worker(out_filename_hmmer, p_filename, in_filename, matrix_filename)
+    return i
+
+def scan_fasta(fasta_filename, k):
+    """
+    Single pass over the input fasta, returning the byte offset of each record
+    (plus the end of the file) and the number of bases each record puts into
+    the first/last k-bp primer search windows
+    """
+    offsets = []
+    window_bases = []
+    position = 0
+    seqlen = None
+    with open(fasta_filename, 'rb') as f:
+        for line in f:
+            if line.startswith('>'):
+                if seqlen is not None:
+                    window_bases.append(2 * min(seqlen, k))
+                offsets.append(position)
+                seqlen = 0
+            elif seqlen is not None:
+                seqlen += len(line.strip())
+            position += len(line)
+    if seqlen is not None:
+        window_bases.append(2 * min(seqlen, k))
+    offsets.append(position)
+    return offsets, window_bases
+
+def balanced_splits(window_bases, num_splits):
+    """
+    Divide the records into at most <num_splits> contiguous runs with roughly
+    equal numbers of window bases, returned as (first, last+1) record indices
+    """
+    if len(window_bases) == 0:
+        return []
+    cumulative = []
+    total = 0
+    for bases in window_bases:
+        total += bases
+        cumulative.append(total)
+    cuts = [0]
+    for j in xrange(1, num_splits):
+        cut = bisect.bisect_left(cumulative, total * j / float(num_splits)) + 1
+        if cuts[-1] < cut < len(window_bases):
+            cuts.append(cut)
+    cuts.append(len(window_bases))
+    return zip(cuts[:-1], cuts[1:])
+
+def read_fasta_range(fasta_filename, start, end):
+    """
+    Parse just the records stored between two byte offsets of a fasta file
+    """
+    with open(fasta_filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return SeqIO.parse(StringIO(data), 'fasta')
+
+def write_primer_windows(records, k, window_filename):
+    with open(window_filename, 'w') as f_in:
+        for r in records:
+            r_seq = r.seq.reverse_complement()
+            f_in.write(">{0}_front\n{1}\n>{0}_back\n{2}\n".format(r.id, r.seq[:k], r_seq[:k]))
+
+def append_file(filename, handle):
+    with open(filename, 'rb') as f:
+        shutil.copyfileobj(f, handle, COPY_BUFFER)
+
+def run_hmmer_and_trim(output_dir, p_filename, p_indices, fasta_filename, output_filename, matrix_filename, k, cpus, see_left, see_right, min_seqlen, min_score, output_anyway, change_seqid):
+    """
+    Run phmmer over splits of the primer windows balanced by bases on a pool
+    of <cpus> workers, parsing and trimming each split as soon as it finishes
+    """
+    out_filename_hmmer = os.path.join(output_dir, 'hmmer.out')
+    offsets, window_bases = scan_fasta(fasta_filename, k)
+    # several splits per worker keep the pool busy, but not so small that
+    # phmmer start-up dominates
+    num_splits = min(cpus * SPLITS_PER_CPU, sum(window_bases) / MIN_SPLIT_BASES)
+    splits = balanced_splits(window_bases, max(1, num_splits))
+    tasks = []
+    for i, (first, last) in enumerate(splits):
+        in_filename = os.path.join(output_dir, 'in.fa_split'+str(i))
+        write_primer_windows(read_fasta_range(fasta_filename, offsets[first], offsets[last]), k, in_filename)
+        tasks.append((i, out_filename_hmmer+'_split'+str(i), p_filename, in_filename, matrix_filename))
+
+    pool = multiprocessing.Pool(cpus)
+    try:
+        for i in pool.imap_unordered(split_worker, tasks):
+            first, last = splits[i]
+            d_front = defaultdict(lambda: None)
+            d_back = defaultdict(lambda: None)
+            parse_hmmer_dom(tasks[i][1], d_front, d_back, min_score)
+            # trim this split's reads while phmmer is still busy with the rest
+            with open(output_filename+'_split'+str(i), 'w') as fout:
+                with open(output_filename+'.primer_info.txt_split'+str(i), 'w') as freport:
+                    records = read_fasta_range(fasta_filename, offsets[first], offsets[last])
+                    trim_records(p_indices, records, fout, freport, d_front, d_back, k, see_left, see_right, min_seqlen, min_score, output_anyway, change_seqid)
+    finally:
+        pool.close()
+        pool.join()
+
+    # stitch the per-split outputs back together in input order
+    with open(out_filename_hmmer, 'wb') as f_hmmer:
+        with open(output_filename, 'wb') as fout:
+            with open(output_filename + '.primer_info.txt', 'wb') as freport:
+                freport.write(REPORT_HEADER)
+                for i in xrange(len(splits)):
+                    append_file(out_filename_hmmer+'_split'+str(i), f_hmmer)
+                    append_file(output_filename+'_split'+str(i), fout)
+                    append_file(output_filename+'.primer_info.txt_split'+str(i), freport)
+    for i in xrange(len(splits)):
+        os.remove(output_filename+'_split'+str(i))
+        os.remove(output_filename+'.primer_info.txt_split'+str(i))
+
+def clean_split_files(output_dir):
+    for filename in glob.glob(os.path.join(output_dir, '*split*')):
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
+
 def hmmer_wrapper_main(output_dir, primer_filename, fasta_filename, output_filename, k=100, cpus=8, see_left=True, see_right=True, min_seqlen=50, min_score=10, output_anyway=False, change_seqid=False):
     # find the matrix file PBMATRIX.txt
     matrix_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'PBMATRIX.txt')
@@ -262,6 +401,10 @@ def hmmer_wrapper_main(output_dir, primer_filename, fasta_filename, output_filen
             for r in SeqIO.parse(open(os.path.join(output_dir, primer_filename)), 'fasta'):
                 if r.id[0] == 'F':
                     p_indices.append(r.id[1:])
+            d_front = defaultdict(lambda: None)
+            d_back = defaultdict(lambda: None)
+            parse_hmmer_dom(out_filename_hmmer, d_front, d_back, min_score)
+            trim_barcode(p_indices, fasta_filename, output_filename, d_front, d_back, k, see_left, see_right, min_seqlen, min_score, output_anyway, change_seqid)
         else:
             print >> sys.stderr, "output directory {0} already exists. Abort.".format(output_dir)
             sys.exit(-1)
@@ -276,47 +419,12 @@ def hmmer_wrapper_main(output_dir, primer_filename, fasta_filename, output_filen
         p_indices = sanity_check_primers(primer_filename, k, p_filename)
 
         print >> sys.stderr, "extracting first and last {0} bases from {1}".format(k, fasta_filename)
-        i = 0
-        size = int(os.popen("grep -c \">\" " + fasta_filename).read()) / cpus + 1
-        count = 0
-        jobs = []
-        f_in = open(os.path.join(output_dir, 'in.fa_split'+str(i)), 'w')
-        for r in SeqIO.parse(open(fasta_filename), 'fasta'):
-            r_seq = r.seq.reverse_complement()
-            f_in.write(">{0}_front\n{1}\n>{0}_back\n{2}\n".format(r.id, r.seq[:k], r_seq[:k]))
-            count += 1
-            if count > size:
-                f_in.close()
-                p = multiprocessing.Process(target=worker, args=(out_filename_hmmer+'_split'+str(i), p_filename, f_in.name, matrix_filename))
-                jobs.append((p, out_filename_hmmer+'_split'+str(i)))
-                p.start()
-                i += 1
-                count = 0
-                f_in = open(os.path.join(output_dir, 'in.fa_split'+str(i)), 'w')
-        f_in.close()
-        if count > 0:
-            p = multiprocessing.Process(target=worker, args=(out_filename_hmmer+'_split'+str(i), p_filename, f_in.name, matrix_filename))
-            jobs.append((p, out_filename_hmmer+'_split'+str(i)))
-            p.start()
-
-        for p, out in jobs:
-            p.join()
-            subprocess.check_call("cat {0} >> {1}".format(out, out_filename_hmmer), shell=True)
-
-        #out_filename_fw = os.path.join(output_dir, 'hmmer.fw.out')
-        #cmd = "phmmer --domtblout {0} -o {0}.hmmer.log --noali --domE 1 --cpu {3} {2} {1}".format(out_filename_hmmer, p_filename, f_in.name, cpus)
-        #print >> sys.stderr, "CMD:", cmd
-        #subprocess.check_call(cmd, shell=True)
-
-    d_front = defaultdict(lambda: None)
-    d_back = defaultdict(lambda: None)
-    parse_hmmer_dom(out_filename_hmmer, d_front, d_back, min_score)
-
-    trim_barcode(p_indices, fasta_filename, output_filename, d_front, d_back, k, see_left, see_right, min_seqlen, min_score, output_anyway, change_seqid)
+        run_hmmer_and_trim(output_dir, p_filename, p_indices, fasta_filename, output_filename, matrix_filename, k, cpus, see_left, see_right, min_seqlen, min_score, output_anyway, change_seqid)
+
     print >> sys.stderr, "Trimmed output fasta filename:", output_filename
     
     print >> sys.stderr, "Cleaning split files"
-    subprocess.check_call("rm -rf {0}/*split*".format(output_dir), shell=True)
+    clean_split_files(output_dir)
 
 if __name__ == "__main__":
     import argparse
@@ -32,9 +32,13 @@
 import os
 import logging
 
-from pbcore.io.FastqIO import FastqRecord, FastqReader, FastqWriter
-from pbcore.io.FastaIO import FastaRecord, FastaWriter  
-from pbrdna.fastq.utils import meanPQv
+import numpy as np
+
+from pbcore.io.FastqIO import FastqReader
+from pbcore.io.FastaIO import FastaRecord
+from pbrdna.fastq.utils import mean_errors, pValueToQv, batch_records
+from pbrdna.io.MothurIO import ListIndex
+from pbrdna.cluster.members import MemberEntry, members_file_for, write_members
 from pbrdna.utils import get_zmw, create_directory, validate_input, validate_float
 
 DEFAULT_DIST = 0.03
@@ -105,10 +109,10 @@ class ClusterSeparator(object):
                                                    maximum=0.5)
 
     def initializeOutputFolder( self ):
-        # Create the output directory if needed and move into it
-        self.origin=   os.getcwd()
+        # Create the output directory if needed, and note which cluster
+        #    files already exist there with a single directory listing
         create_directory( self.outputDir )
-        os.chdir( self.outputDir )
+        self.existingFiles = frozenset( os.listdir( self.outputDir ) )
 
     #################
     # Class Methods #
@@ -127,24 +131,43 @@ class ClusterSeparator(object):
     ####################
 
     def parseSequenceData(self):
-        self.sequenceData = {}
-        self.qualityData = {}
-        for record in FastqReader( self.ccsFile ):
-            zmw = get_zmw( record.name )
-            new_record = FastqRecord(zmw, record.sequence, record.quality)
-            self.sequenceData[zmw] = new_record
-            self.qualityData[zmw] = meanPQv(new_record)
+        # Reads are stored as one concatenated sequence string with
+        #    per-read offset, length and mean QV arrays, and referred
+        #    to elsewhere by their index in those arrays
+        self.readIndex = {}
+        self.readNames = []
+        sequences = []
+        lengths = []
+        meanQvs = []
+        for batch in batch_records( FastqReader( self.ccsFile ) ):
+            for record in batch:
+                zmw = get_zmw( record.name )
+                # Like a dictionary, the last record seen for a ZMW wins
+                self.readIndex[zmw] = len(self.readNames)
+                self.readNames.append( zmw )
+                sequences.append( record.sequence )
+                lengths.append( len(record.sequence) )
+            errors = mean_errors( [record.quality for record in batch] )
+            meanQvs.append( pValueToQv( errors ) )
+        self.sequenceData = ''.join( sequences )
+        self.readLengths = np.array( lengths, dtype=np.int64 )
+        self.readStarts = np.cumsum( self.readLengths ) - self.readLengths
+        if meanQvs:
+            self.readQvs = np.concatenate( meanQvs )
+        else:
+            self.readQvs = np.zeros( 0 )
+
+    def readSequence(self, read):
+        start = self.readStarts[read]
+        return self.sequenceData[start:start+self.readLengths[read]]
 
     def parseDistances(self):
-        distances = []
-        with open( self.listFile, 'r' ) as handle:
-            for line in handle:
-                if line.startswith('label'):
-                    continue
-                parts = line.split()
-                distance = self.convertDistance( parts[0] )
-                distances.append( distance )
-        return distances
+        self.listIndex = ListIndex( self.listFile )
+        self.distanceLabels = {}
+        for label in self.listIndex.labels:
+            distance = self.convertDistance( label )
+            self.distanceLabels.setdefault( distance, label )
+        return self.distanceLabels.keys()
 
     def selectDistance(self, distances):
         # If our selected distance is present, simply return it
@@ -158,98 +181,114 @@ class ClusterSeparator(object):
             raise ValueError('No valid clustering distances found!')
         return max(smaller)
 
+    def countClusters( self, targetDist ):
+        return self.listIndex.clusterCount( self.distanceLabels[targetDist] )
+
     def parseClusters( self, targetDist ):
-        with open( self.listFile, 'r' ) as handle:
-            for line in handle:
-                if line.startswith('label'):
-                    continue
-                # Skip lines until we find the target distance
-                parts = line.split()
-                currDist = self.convertDistance( parts[0] )
-                if currDist != targetDist:
-                    continue
-                # Check that the number of clusters is concordant
-                clusterCount = int(parts[1])
-                clusters = parts[2:]
-                assert len(clusters) == clusterCount
-                # Convert the strings of clusters to Lists and return
-                clusters = [c.split(',') for c in clusters]
-                return clusters
+        # Seek straight to the target distance and parse it lazily
+        return self.listIndex.clusters( self.distanceLabels[targetDist] )
 
     def trimClusterNames(self, clusters):
-        trimmed = []
+        # A generator, so clusters stream from the list file one at a time
         for cluster in clusters:
-            cluster = [get_zmw(c) for c in cluster]
-            trimmed.append( frozenset(cluster) )
-        return trimmed
+            yield frozenset( get_zmw(c) for c in cluster )
 
     def getClusterReads(self, cluster):
         reads = []
         for ccsZmw in cluster:
             try:
-                ccsRead = self.sequenceData[ccsZmw]
+                reads.append( self.readIndex[ccsZmw] )
             except KeyError:
                 #raise Warning("No CCS read found for '%s', skipping..." % ccsZmw)
                 continue
-            reads.append( ccsRead )
-        return reads
+        return np.array( reads, dtype=np.int64 )
+
+    def outputPath( self, filename ):
+        return os.path.join( self.outputDir, filename )
+
+    def writeFastaRecords( self, filename, records ):
+        # Format the whole file in memory and write it with a single call
+        text = ''.join( str(record) + '\n' for record in records )
+        with open( self.outputPath( filename ), 'w' ) as handle:
+            handle.write( text )
 
     def outputClusterFasta( self, reads, count ):
         fastaFile = 'cluster%s.fasta' % count
-        if os.path.exists( fastaFile ):
+        if fastaFile in self.existingFiles:
             return fastaFile
-        # Rename the "Reference" sequence to the cluster
-        with FastaWriter( fastaFile ) as handle:
-            for fastqRecord in reads:
-                fastaRecord = FastaRecord( fastqRecord.name,
-                                           fastqRecord.sequence )
-                handle.writeRecord( fastaRecord )
+        fastaRecords = [FastaRecord( self.readNames[read], self.readSequence( read ) )
+                        for read in reads]
+        self.writeFastaRecords( fastaFile, fastaRecords )
         return fastaFile
 
     def pickReference( self, reads ):
-        longReads = [read for read in reads
-                          if len(read.sequence) > self.minRefLength]
-        if longReads:
+        if (self.readLengths[reads] > self.minRefLength).any():
             return self.findLowestErrorRead( reads )
         # If no 'full-length' reads are present, simply return the longest
         else:
             return self.findLongestRead( reads )
 
     def findLowestErrorRead( self, reads ):
-        pQvs = [self.qualityData[read.name] for read in reads]
-        maxQv = max(pQvs)
-        lowestErrorReads = [read for read in reads
-                                 if self.qualityData[read.name] == maxQv]
-        return lowestErrorReads[0]
+        # Empty reads have a NaN mean QV and are skipped, and nanargmax
+        #    returns the first of any tied reads
+        return reads[np.nanargmax( self.readQvs[reads] )]
 
     def findLongestRead( self, reads ):
-        lengths = [len(read.sequence) for read in reads]
-        maxLength = max(lengths)
-        longestReads = [read for read in reads
-                             if len(read.sequence) == maxLength]
-        return longestReads[0]
+        return reads[np.argmax( self.readLengths[reads] )]
 
     def outputReferenceFasta( self, reference, count):
-        print "Creating reference sequence for Cluster #%s" % count
+        log.debug("Creating reference sequence for Cluster #%s" % count)
         referenceFile = 'cluster%s_ref.fasta' % count
-        reference_desc = 'cluster{0}_reference\t{1}'.format(count, reference.name)
-        if os.path.exists( referenceFile ):
+        reference_desc = '{0}\t{1}'.format(self.referenceName( count ), self.readNames[reference])
+        if referenceFile in self.existingFiles:
             return referenceFile
-        with FastaWriter( referenceFile ) as handle:
-            referenceFasta = FastaRecord( reference_desc,
-                                          reference.sequence )
-            handle.writeRecord( referenceFasta )
+        referenceFasta = FastaRecord( reference_desc,
+                                      self.readSequence( reference ) )
+        self.writeFastaRecords( referenceFile, [referenceFasta] )
         return referenceFile
 
+    def referenceName( self, count ):
+        return 'cluster{0}_reference'.format(count)
+
+    def outputClusterFiles( self, clusters ):
+        clusterFiles = []
+        self.clusterMembers = []
+        for count, cluster in enumerate( clusters ):
+            count = str(count+1).zfill(4)
+            log.debug("Analyzing cluster #%s now..." % count)
+            reads = self.getClusterReads( cluster )
+            clusterFile = self.outputClusterFasta( reads, count )
+            referenceName = 'None'
+            if len(reads) >= self.min_cluster_size:
+                if len(reads) == 1:
+                    referenceFile = clusterFile
+                    referenceName = self.readNames[reads[0]]
+                else:
+                    reference = self.pickReference( reads )
+                    referenceFile = self.outputReferenceFasta( reference, count )
+                    referenceName = self.referenceName( count )
+                clusterFiles.append( (clusterFile, referenceFile, len(reads)) )
+            else:
+                clusterFiles.append( (clusterFile, 'None', len(reads)) )
+            # Record the membership of each cluster while it's in memory
+            self.clusterMembers.append( MemberEntry( self.outputPath( clusterFile ),
+                                                     referenceName, 'None',
+                                                     [self.readNames[read] for read in reads],
+                                                     self.readQvs[reads].tolist() ) )
+        return clusterFiles
+
     def outputClusterFileList( self, clusterFiles ):
-        print "Writing out the names of the individual cluster files"
+        log.info("Writing out the names of the individual cluster files")
+        lines = []
+        for clusterFile, referenceFile, count in clusterFiles:
+            clusterPath = self.outputPath( clusterFile )
+            referencePath = self.outputPath( referenceFile )
+            lines.append('{0}\t{1}\t{2}\n'.format(clusterPath,
+                                                  referencePath,
+                                                  count))
         with open( self.output, 'w') as handle:
-            for clusterFile, referenceFile, count in clusterFiles:
-                clusterPath = os.path.join( self.outputDir, clusterFile )
-                referencePath = os.path.join( self.outputDir, referenceFile )
-                handle.write('{0}\t{1}\t{2}\n'.format(clusterPath, 
-                                                      referencePath, 
-                                                      count))
+            handle.write( ''.join( lines ) )
+        write_members( self.clusterMembers, members_file_for( self.output ) )
         return self.output
 
     def __call__( self ):
@@ -260,29 +299,14 @@ class ClusterSeparator(object):
         distances = self.parseDistances()
         distance = self.selectDistance( distances )
         log.info("Distance: %s" % distance)
+        log.info("Clusters found: %s" % self.countClusters( distance ))
         clusters = self.parseClusters( distance )
-        log.info("Clusters found: %s" % len(clusters))
 
-        # Trim the cluster neams and iterate, outputing each subset
+        # Trim the cluster names and output every subset in one sweep
         trimmedClusters = self.trimClusterNames( clusters )
-        clusterFiles = []
-        for count, cluster in enumerate( trimmedClusters ):
-            count = str(count+1).zfill(4)
-            log.info("Analyzing cluster #%s now..." % count)
-            reads = self.getClusterReads( cluster )
-            clusterFile = self.outputClusterFasta( reads, count )
-            if len(reads) >= self.min_cluster_size:
-                if len(reads) == 1:
-                    referenceFile = clusterFile
-                else:
-                    reference = self.pickReference( reads )
-                    referenceFile = self.outputReferenceFasta( reference, count )
-                clusterFiles.append( (clusterFile, referenceFile, len(reads)) )
-            else:
-                clusterFiles.append( (clusterFile, 'None', len(reads)) )
+        clusterFiles = self.outputClusterFiles( trimmedClusters )
 
-        # Return to the origin directory and output the results summary
-        os.chdir( self.origin )
+        # Output the results summary
         if self.output:
             return self.outputClusterFileList( clusterFiles )
         return
@@ -15,6 +15,8 @@ def clean_consensus_outputs( dir_path, output_file ):
             os.remove( file_path )
         elif file_path.endswith('_input.fa.aln_unsorted'):
             os.remove( file_path )
+        elif file_path.endswith('_subset.fasta'):
+            os.remove( file_path )
     write_dummy_file( output_file )
 
 if __name__ == '__main__':
@@ -3,40 +3,204 @@
 __author__ = 'Brett Bowman'
 __email__ = 'bbowman@pacificbiosciences.com'
 
+import os
+import logging
+
+from collections import namedtuple
+
+import numpy as np
+
+from pbcore.io.FastaIO import FastaReader, FastaWriter
+
 from pbrdna.resequence.DagConTools import DagConRunner
-from pbrdna.fasta.utils import fasta_count
+from pbrdna.fasta.utils import fasta_header_count, fasta_first_name
+from pbrdna.cluster.members import members_file_for, read_members, write_members
 
-def generate_consensus_files( cluster_list, consensus_tool, output_file ):
+MAX_DEPTH = None
+SEED = 42
+
+ConsensusEntry = namedtuple('ConsensusEntry', ['sequence_file', 'reference_file',
+                                               'consensus_file', 'sequence_count',
+                                               'consensus_count', 'consensus_depth'])
+
+log = logging.getLogger(__name__)
+
+def generate_consensus_files( cluster_list, consensus_tool, output_file, max_depth=MAX_DEPTH,
+                                                                         seed=SEED ):
     consensus_files = []
+    jobs = []
     with open( cluster_list ) as handle:
         for line in handle:
             sequence_file, reference_file, count = line.strip().split()
-            print sequence_file, reference_file
+            count = int(count)
+            log.debug('%s\t%s' % (sequence_file, reference_file))
             if reference_file.endswith('None'):
-                consensus_files.append( (sequence_file, 'None', 'None') )
-            elif fasta_count( sequence_file ) == 1:
-                consensus_files.append( (sequence_file, reference_file, 'None') )
+                consensus_files.append( (sequence_file, 'None', 'None', count, 0, 0) )
+            elif count == 1:
+                consensus_files.append( (sequence_file, reference_file, 'None', count, 0, 0) )
             else:
-                consensus = consensus_tool( sequence_file, reference_file )
-                consensus_files.append( (sequence_file, reference_file, consensus) )
+                # Hold the cluster's place in the output until its job is done
+                jobs.append( (len(consensus_files), count,
+                              sequence_file, reference_file) )
+                consensus_files.append( None )
+    if max_depth:
+        jobs = cap_consensus_depth( jobs, cluster_list, consensus_tool, max_depth, seed )
+    else:
+        # Every cluster runs on its own file at full depth
+        jobs = [job + (job[2], job[1]) for job in jobs]
+    for index, consensus_file in run_consensus_jobs( jobs, consensus_tool ):
+        consensus_files[index] = consensus_file
     write_consensus_files( consensus_files, output_file )
+    write_consensus_members( cluster_list, consensus_files, output_file )
+
+def cap_consensus_depth( jobs, cluster_list, consensus_tool, max_depth, seed=SEED ):
+    """
+    Point each job for a cluster above max_depth reads at a subset of its
+    best reads, adding the file to run consensus on and the depth used
+    """
+    cluster_members = members_file_for( cluster_list )
+    if os.path.exists( cluster_members ):
+        members = read_members( cluster_members )
+    else:
+        members = {}
+    capped = []
+    for job in jobs:
+        index, count, sequence_file, reference_file = job
+        if count <= max_depth:
+            capped.append( job + (sequence_file, count) )
+        elif sequence_file not in members:
+            log.warn('No membership data for "%s", using all %s reads' % (sequence_file, count))
+            capped.append( job + (sequence_file, count) )
+        elif os.path.exists( consensus_tool.getOutputFile( sequence_file ) ):
+            # Already done by an earlier run, so the subset isn't needed
+            capped.append( job + (sequence_file, max_depth) )
+        else:
+            subset_file = subsample_cluster( sequence_file, members[sequence_file],
+                                             max_depth, seed )
+            capped.append( job + (subset_file, max_depth) )
+    return capped
+
+def select_consensus_reads( entry, max_depth, seed=SEED ):
+    """
+    Pick the max_depth highest mean-QV members of a cluster, breaking ties
+    with a seeded shuffle so that reruns pick the same reads
+    """
+    tie_break = np.random.RandomState( seed ).random_sample( len(entry.members) )
+    if entry.member_qvs is None:
+        order = np.argsort( tie_break )
+    else:
+        order = np.lexsort( (tie_break, -np.array( entry.member_qvs )) )
+    return frozenset( entry.members[i] for i in order[:max_depth] )
+
+def subsample_cluster( sequence_file, entry, max_depth, seed=SEED ):
+    selected = select_consensus_reads( entry, max_depth, seed )
+    root, ext = os.path.splitext( sequence_file )
+    subset_file = root + '_subset' + ext
+    log.info('Capping "%s" at %s of its %s reads' % (sequence_file, max_depth,
+                                                     len(entry.members)))
+    with FastaWriter( subset_file ) as writer:
+        for record in FastaReader( sequence_file ):
+            if record.name.split()[0] in selected:
+                writer.writeRecord( record )
+    return subset_file
+
+def run_consensus_jobs( jobs, consensus_tool ):
+    """
+    Submit every consensus job to the tool's worker pool, largest clusters
+    first so they don't dominate the tail, and collect their results
+    """
+    jobs = sorted( jobs, key=lambda job: job[1], reverse=True )
+    log.info('Generating consensus sequences for %s clusters with %s workers' % (len(jobs),
+                                                                               consensus_tool.nproc))
+    failed = 0
+    try:
+        # Subsets are named for their cluster, whichever reads they hold
+        results = [consensus_tool.submit( input_file, reference_file,
+                                          consensus_tool.getOutputFile( sequence_file ) )
+                   for index, count, sequence_file, reference_file, input_file, depth in jobs]
+        for job, result in zip( jobs, results ):
+            index, count, sequence_file, reference_file, input_file, depth = job
+            consensus = result.get()
+            if consensus is None:
+                # Recorded without a consensus, so the reference is used instead
+                failed += 1
+                yield (index, (sequence_file, reference_file, 'None', count, 0, 0))
+                continue
+            yield (index, (sequence_file, reference_file, consensus,
+                           count, fasta_header_count( consensus ), depth))
+    finally:
+        consensus_tool.close()
+    if failed:
+        log.warn('Consensus failed for %s of %s clusters, using their references' % (failed,
+                                                                                 len(jobs)))
 
 def generate_reference_files( cluster_list, output_file ):
     consensus_files = []
     with open( cluster_list ) as handle:
         for line in handle:
             sequence_file, reference_file, count = line.strip().split()
-            print sequence_file, reference_file
+            count = int(count)
+            log.debug('%s\t%s' % (sequence_file, reference_file))
             if reference_file.endswith('None'):
-                consensus_files.append( (sequence_file, 'None', 'None') )
+                consensus_files.append( (sequence_file, 'None', 'None', count, 0, 0) )
             else:
-                consensus_files.append( (sequence_file, reference_file, 'None') )
+                consensus_files.append( (sequence_file, reference_file, 'None', count, 0, 0) )
     write_consensus_files( consensus_files, output_file )
+    write_consensus_members( cluster_list, consensus_files, output_file )
+
+def write_consensus_members( cluster_list, consensus_files, output_file ):
+    """
+    Carry the membership table of a cluster list forward to its consensus
+    manifest, adding the name of each cluster's consensus sequence
+    """
+    cluster_members = members_file_for( cluster_list )
+    if not os.path.exists( cluster_members ):
+        return None
+    members = read_members( cluster_members )
+    entries = []
+    for filename_set in consensus_files:
+        sequence_file, reference_file, consensus, count, consensus_count, depth = filename_set
+        entry = members[sequence_file]
+        if consensus_count > 0:
+            entry = entry._replace( consensus_name=fasta_first_name( consensus ) )
+        entries.append( entry )
+    return write_members( entries, members_file_for( output_file ) )
 
 def write_consensus_files( consensus_files, output_file ):
     with open( output_file, 'w' ) as handle:
         for filename_set in consensus_files:
-            handle.write('%s\t%s\t%s\n' % filename_set)
+            handle.write('%s\t%s\t%s\t%s\t%s\t%s\n' % filename_set)
+
+def read_consensus_files( consensus_file ):
+    """
+    Parse the entries of a .consensus manifest, including older
+    manifests which carry no record counts or consensus depths
+    """
+    with open( consensus_file ) as handle:
+        for line in handle:
+            parts = line.strip().split()
+            counts = [int(count) for count in parts[3:]]
+            counts += [None] * (3 - len(counts))
+            yield ConsensusEntry( *(parts[:3] + counts) )
+
+def consensus_failed( entry ):
+    """
+    Whether a cluster large enough for a consensus was recorded without one
+    """
+    return entry.consensus_file.endswith('None') and \
+           not entry.reference_file.endswith('None') and \
+           entry.sequence_count is not None and entry.sequence_count > 1
+
+def consensus_count( entry ):
+    """
+    Return the number of consensus records for a manifest entry, counting
+    them from the file itself only if the manifest doesn't record it
+    """
+    if entry.consensus_file.endswith('None'):
+        return 0
+    elif entry.consensus_count is None:
+        return fasta_header_count( entry.consensus_file )
+    return entry.consensus_count
 
 if __name__ == '__main__':
     import sys
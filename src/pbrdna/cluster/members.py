@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+__author__ = 'Brett Bowman'
+__email__ = 'bbowman@pacificbiosciences.com'
+
+from collections import namedtuple
+
+MEMBERS_SUFFIX = '.members'
+
+MemberEntry = namedtuple('MemberEntry', ['cluster_file', 'reference_name',
+                                         'consensus_name', 'members',
+                                         'member_qvs'])
+
+def members_file_for( manifest_file ):
+    """
+    Return the name of the membership table that accompanies a cluster
+    list or consensus manifest
+    """
+    return manifest_file + MEMBERS_SUFFIX
+
+def write_members( entries, output_file ):
+    with open( output_file, 'w' ) as handle:
+        for entry in entries:
+            if entry.member_qvs is None:
+                qvs = ''
+            else:
+                qvs = ','.join( '%.3f' % qv for qv in entry.member_qvs )
+            handle.write('%s\t%s\t%s\t%s\t%s\n' % (entry.cluster_file,
+                                                   entry.reference_name,
+                                                   entry.consensus_name,
+                                                   ','.join(entry.members),
+                                                   qvs))
+    return output_file
+
+def read_members( members_file ):
+    """
+    Parse a membership table, including older tables without member QVs
+    """
+    members = {}
+    with open( members_file ) as handle:
+        for line in handle:
+            parts = line.rstrip('\n').split('\t')
+            cluster_file, reference_name, consensus_name, names = parts[:4]
+            names = names.split(',') if names else []
+            if len(parts) > 4 and parts[4]:
+                qvs = [float(qv) for qv in parts[4].split(',')]
+            else:
+                qvs = None
+            members[cluster_file] = MemberEntry( cluster_file, reference_name,
+                                                 consensus_name, names, qvs )
+    return members
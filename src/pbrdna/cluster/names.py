@@ -4,11 +4,16 @@ __author__ = 'Brett Bowman'
 __email__ = 'bbowman@pacificbiosciences.com'
 
 from pbrdna.fasta.utils import fasta_names
+from pbrdna.cluster.generate import read_consensus_files, consensus_count
+from pbrdna.cluster.members import read_members
 
-def create_name_file( consensus_file, selected_file, output_file ):
+def create_name_file( consensus_file, selected_file, output_file, members_file=None ):
     selected = read_selected_files( selected_file )
-    data_files = read_file_data( consensus_file, selected )
-    sequence_names = read_sequence_names( data_files )
+    if members_file is None:
+        data_files = read_file_data( consensus_file, selected )
+        sequence_names = read_sequence_names( data_files )
+    else:
+        sequence_names = read_member_names( consensus_file, selected, members_file )
     output_names( sequence_names, output_file )
 
 def read_selected_files( selected_file ):
@@ -21,17 +26,43 @@ def read_selected_files( selected_file ):
 
 def read_file_data( consensus_file, selected ):
     file_data = {}
-    with open( consensus_file ) as handle:
-        for line in handle:
-            source, ref, consensus = line.strip().split()
-            if consensus in selected:
-                file_data[consensus] = source
-            elif ref in selected:
-                file_data[ref] = source
-            elif source in selected:
-                file_data[source] = source
+    for entry in read_consensus_files( consensus_file ):
+        source, ref, consensus = entry[:3]
+        if consensus in selected:
+            file_data[consensus] = source
+        elif ref in selected:
+            file_data[ref] = source
+        elif source in selected:
+            file_data[source] = source
     return file_data
 
+def read_member_names( consensus_file, selected, members_file ):
+    """
+    Build the same name map as read_sequence_names from a cluster
+    membership table, without reading any of the cluster Fasta files
+    """
+    members = read_members( members_file )
+    sequence_names = {}
+    for entry in read_consensus_files( consensus_file ):
+        cluster = members[entry.sequence_file]
+        if entry.consensus_file in selected:
+            if consensus_count( entry ) != 1:
+                raise ValueError
+            add_sequence_names( sequence_names, cluster.consensus_name, cluster.members )
+        elif entry.reference_file in selected:
+            add_sequence_names( sequence_names, cluster.reference_name, cluster.members )
+        elif entry.sequence_file in selected:
+            if len( cluster.members ) == 1:
+                add_sequence_names( sequence_names, cluster.members[0], cluster.members )
+            else:
+                for name in cluster.members:
+                    add_sequence_names( sequence_names, name, [name] )
+    return sequence_names
+
+def add_sequence_names( sequence_names, reference, names ):
+    assert reference not in sequence_names
+    sequence_names[reference] = names
+
 def read_sequence_names( data_files ):
     sequence_names = {}
     for reference, source in data_files.iteritems():
@@ -3,41 +3,38 @@
 __author__ = 'Brett Bowman'
 __email__ = 'bbowman@pacificbiosciences.com'
 
-from pbrdna.fasta.utils import fasta_count
+from pbrdna.cluster.generate import read_consensus_files, consensus_count, consensus_failed
 
 def select_consensus_files( consensus_file, output_file ):
     selected_files = []
-    with open( consensus_file ) as handle:
-        for line in handle:
-            sequence_file, reference_file, consensus_file = line.strip().split()
-            if consensus_file.endswith('None'):
-                pass
-            elif fasta_count( consensus_file ) == 1:
-                selected_files.append( consensus_file )
-            else:
-                selected_files.append( reference_file )
+    for entry in read_consensus_files( consensus_file ):
+        if consensus_failed( entry ):
+            selected_files.append( entry.reference_file )
+        elif entry.consensus_file.endswith('None'):
+            pass
+        elif consensus_count( entry ) == 1:
+            selected_files.append( entry.consensus_file )
+        else:
+            selected_files.append( entry.reference_file )
     output_selected_consensus( output_file, selected_files )
 
 def select_combined_sequences( consensus_file, output_file ):
     selected_files = []
-    with open( consensus_file ) as handle:
-        for line in handle:
-            sequence_file, reference_file, consensus_file = line.strip().split()
-            if consensus_file.endswith('None'):
-                selected_files.append( sequence_file )
-            elif fasta_count( consensus_file ) >= 1:
-                selected_files.append( consensus_file )
-            else:
-                selected_files.append( sequence_file )
+    for entry in read_consensus_files( consensus_file ):
+        if entry.consensus_file.endswith('None'):
+            # Including clusters whose consensus failed
+            selected_files.append( entry.sequence_file )
+        elif consensus_count( entry ) >= 1:
+            selected_files.append( entry.consensus_file )
+        else:
+            selected_files.append( entry.sequence_file )
     output_selected_consensus( output_file, selected_files )
 
 def select_reference_files( consensus_file, output_file ):
     selected_files = []
-    with open( consensus_file ) as handle:
-        for line in handle:
-            sequence_file, reference_file, consensus_file = line.strip().split()
-            if not reference_file.endswith('None'):
-                selected_files.append( reference_file )
+    for entry in read_consensus_files( consensus_file ):
+        if not entry.reference_file.endswith('None'):
+            selected_files.append( entry.reference_file )
     output_selected_consensus( output_file, selected_files )
 
 def output_selected_consensus( output_file, selected_files ):
@@ -1,5 +1,7 @@
 from pbcore.io.FastaIO import FastaReader, FastaWriter
 
+from pbrdna.utils import COPY_BUFFER
+
 def fasta_count( fasta_file ):
     count = 0
     try:
@@ -10,6 +12,37 @@ def fasta_count( fasta_file ):
         return 0
     return count
 
+def fasta_header_count( fasta_file ):
+    """
+    Count the records with a non-empty sequence in a Fasta file like
+    fasta_count, but by scanning lines rather than building records
+    """
+    count = 0
+    in_record = False
+    has_sequence = False
+    try:
+        with open( fasta_file ) as handle:
+            for line in handle:
+                if line.startswith('>'):
+                    count += has_sequence
+                    in_record = True
+                    has_sequence = False
+                elif in_record and not has_sequence and line.strip():
+                    has_sequence = True
+    except IOError:
+        return 0
+    return count + has_sequence
+
+def fasta_first_name( fasta_file ):
+    """
+    Return the first word of the first header in a Fasta file
+    """
+    with open( fasta_file ) as handle:
+        for line in handle:
+            if line.startswith('>'):
+                return line[1:].split()[0]
+    return None
+
 def fasta_names( fasta_file ):
     return set([f.name.strip() for f in FastaReader( fasta_file )])
 
@@ -17,12 +50,42 @@ def copy_fasta_sequences( fasta_file, fasta_writer ):
     for fasta_record in FastaReader( fasta_file ):
         fasta_writer.writeRecord( fasta_record )
 
-def copy_fasta_list( sequence_list, output_file ):
-    with FastaWriter( output_file ) as writer:
-        with open( sequence_list ) as handle:
-            for line in handle:
-                sequence_file = line.strip()
+def copy_fasta_text( fasta_file, output_handle ):
+    """
+    Append the raw text of a Fasta file to an open handle in large blocks,
+    normalizing its line endings and ending it with a newline
+    """
+    last_char = '\n'
+    with open( fasta_file, 'rb' ) as handle:
+        while True:
+            block = handle.read( COPY_BUFFER )
+            if not block:
+                break
+            if '\r' in block:
+                # Don't split a CRLF pair across two blocks
+                if block.endswith('\r'):
+                    block += handle.read( 1 )
+                block = block.replace('\r\n', '\n').replace('\r', '\n')
+            output_handle.write( block )
+            last_char = block[-1]
+    if last_char != '\n':
+        output_handle.write('\n')
+
+def copy_fasta_list( sequence_list, output_file, validate=False ):
+    """
+    Concatenate the Fasta files named in a list file, either as raw text
+    or, when validating, by parsing and re-writing every record
+    """
+    with open( sequence_list ) as handle:
+        sequence_files = [line.strip() for line in handle if line.strip()]
+    if validate:
+        with FastaWriter( output_file ) as writer:
+            for sequence_file in sequence_files:
                 copy_fasta_sequences( sequence_file, writer )
+    else:
+        with open( output_file, 'wb' ) as output:
+            for sequence_file in sequence_files:
+                copy_fasta_text( sequence_file, output )
 
 if __name__ == '__main__':
     import sys
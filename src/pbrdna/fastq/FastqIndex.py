@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+__author__ = 'bbowman@pacificbiosciences.com'
+
+import os
+import mmap
+import logging
+
+from array import array
+
+import numpy as np
+
+from pbcore.io.FastqIO import FastqRecord
+from pbrdna.io.sidecar import load_sidecar, save_sidecar
+
+log = logging.getLogger(__name__)
+
+class FastqIndex(object):
+    """
+    An on-disk index of the byte offset of each ZMW's record in a FASTQ
+    file, providing random access to the records through mmap
+    """
+    SUFFIX = '.zmwidx.npz'
+
+    ##########################
+    # Initialization Methods #
+    ##########################
+
+    def __init__(self, fastqFile, indexFile=None):
+        self.fastq = fastqFile
+        if indexFile is None:
+            self.indexFile = fastqFile + self.SUFFIX
+        else:
+            self.indexFile = indexFile
+        index = load_sidecar( self.indexFile, self.fastq )
+        if index is None:
+            index = self.buildIndex()
+        else:
+            log.info('Using existing ZMW index "%s"' % self.indexFile)
+        self.loadIndex( index )
+        self.openFastq()
+
+    def buildIndex(self):
+        log.info('Building a ZMW index for "%s"...' % self.fastq)
+        movieIds = {}
+        keys = array('l')
+        offsets = array('l')
+        position = 0
+        with open( self.fastq, 'rb' ) as handle:
+            while True:
+                lines = [handle.readline() for i in range(4)]
+                if not lines[0]:
+                    break
+                movie, hole = self.splitZmw( lines[0][1:].strip() )
+                movieId = movieIds.setdefault( movie, len(movieIds) )
+                keys.append( self.makeKey( movieId, hole ) )
+                offsets.append( position )
+                position += sum( len(line) for line in lines )
+        keys = np.array( keys, dtype=np.int64 )
+        offsets = np.array( offsets, dtype=np.int64 )
+        order = np.argsort( keys, kind='mergesort' )
+        movies = sorted( movieIds, key=movieIds.get )
+        index = {'keys': keys[order],
+                 'offsets': offsets[order],
+                 'movies': np.array( movies )}
+        log.info('Indexed %s Fastq records from "%s"' % (len(keys), self.fastq))
+        # The index still works from memory if it can't be saved
+        if save_sidecar( self.indexFile, self.fastq, **index ) is None:
+            log.warn('Unable to save the ZMW index "%s"' % self.indexFile)
+        return index
+
+    def loadIndex(self, index):
+        self.keys = index['keys']
+        self.offsets = index['offsets']
+        self.movieIds = dict( (str(m), i) for i, m in enumerate(index['movies']) )
+
+    def openFastq(self):
+        self.handle = open( self.fastq, 'rb' )
+        if os.path.getsize( self.fastq ) > 0:
+            self.data = mmap.mmap( self.handle.fileno(), 0, access=mmap.ACCESS_READ )
+        else:
+            self.data = ''
+
+    #################
+    # Class Methods #
+    #################
+
+    @classmethod
+    def splitZmw(cls, name):
+        parts = name.split()[0].split('/')
+        try:
+            return (parts[0], int(parts[1]))
+        except (IndexError, ValueError):
+            raise ValueError('"%s" is not a valid PacBio read name!' % name)
+
+    @classmethod
+    def makeKey(cls, movieId, hole):
+        return (movieId << 32) | hole
+
+    ####################
+    # Instance Methods #
+    ####################
+
+    def findOffset(self, zmw):
+        movie, hole = self.splitZmw( zmw )
+        try:
+            key = self.makeKey( self.movieIds[movie], hole )
+        except KeyError:
+            raise KeyError( zmw )
+        # Like a dictionary, the last record seen for a ZMW wins
+        i = np.searchsorted( self.keys, key, side='right' ) - 1
+        if i < 0 or self.keys[i] != key:
+            raise KeyError( zmw )
+        return int(self.offsets[i])
+
+    def readRecord(self, offset):
+        lines = []
+        start = offset
+        for i in range(4):
+            end = self.data.find( '\n', start )
+            if end < 0:
+                end = len(self.data)
+            lines.append( self.data[start:end].rstrip('\r') )
+            start = end + 1
+        return FastqRecord( lines[0][1:].strip(), lines[1],
+                            qualityString=lines[3] )
+
+    def __getitem__(self, zmw):
+        return self.readRecord( self.findOffset( zmw ) )
+
+    def __contains__(self, zmw):
+        try:
+            self.findOffset( zmw )
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        if isinstance( self.data, mmap.mmap ):
+            self.data.close()
+        self.handle.close()
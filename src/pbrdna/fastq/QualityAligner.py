@@ -1,18 +1,17 @@
 import sys
-import re
 import os
-import csv
-import subprocess
 import logging
 
 from collections import namedtuple
-from random import random
 from string import maketrans
 
-from pbcore.io.FastaIO import FastaRecord, FastaReader, FastaWriter
-from pbcore.io.FastqIO import FastqRecord, FastqReader, FastqWriter
+import numpy as np
 
-logging.getLogger(__name__)
+from pbcore.io.FastaIO import FastaRecord, FastaReader
+from pbcore.io.FastqIO import FastqRecord, FastqWriter
+from pbrdna.fastq.FastqIndex import FastqIndex
+
+log = logging.getLogger(__name__)
 
 class QualityAligner(object):
     """
@@ -21,6 +20,8 @@ class QualityAligner(object):
     """
 
     DNA_TRANSLATOR = maketrans('AGCT', 'TCGA')
+    GAP_CHARS = '-.'
+    GAP_QV = ord('!')
 
     BlasrRecord = namedtuple('BlasrRecord', ['qname', 'tname', 'qstrand', 'tstrand',
                                              'score', 'pctsimilarity', 
@@ -122,56 +123,46 @@ class QualityAligner(object):
 
     @classmethod
     def getZmw(cls, record):
-        parts = record.name.split('/')
+        return cls.getZmwFromName( record.name )
+
+    @classmethod
+    def getZmwFromName(cls, name):
+        parts = name.split()[0].split('/')
         zmw = '/'.join( parts[0:2] )
         return zmw
 
     @classmethod
-    def getSeqParts(cls, record):
-        parts = re.split('(\.+|-+|\w+)', record.sequence)
-        parts = [len(p) if re.match('(\.|-)', p) else p
-                        for p in parts 
-                        if p != '']
-        return parts
+    def getGapMask(cls, record):
+        sequence = np.frombuffer( record.sequence, dtype=np.uint8 )
+        gapMask = np.zeros( len(sequence), dtype=bool )
+        for gapChar in cls.GAP_CHARS:
+            gapMask |= (sequence == ord(gapChar))
+        return gapMask
 
     @classmethod
-    def createUnalignedRecord(cls, seqParts, zmw):
-        bases = [b for b in seqParts if type(b) is str]
-        unalignedSequence = ''.join(bases)
+    def createUnalignedRecord(cls, alignedRecord, zmw):
+        unalignedSequence = alignedRecord.sequence.translate(None, cls.GAP_CHARS)
         unalignedRecord = FastaRecord( zmw, unalignedSequence )
         return unalignedRecord
 
     @classmethod
-    def runBlasr(cls, fastqRecord, alignedRecord):
-        # Write the query and reference records to file
-        tempId = str(int(random() * 10000000))
-        tempRef = 'temp_ref_%s.fasta' % tempId
-        with FastaWriter(tempRef) as handle:
-            fastaRecord = cls.convertFastqToFasta( fastqRecord )
-            handle.writeRecord( fastaRecord )
-        tempQuery = 'temp_query_%s.fasta' % tempId 
-        with FastaWriter(tempQuery) as handle:
-            handle.writeRecord( alignedRecord )
-        # Create and run the command-line
-        tempOut = 'temp_%s.m1' % tempId
-        cline = 'blasr %s %s -m 1 -bestn 1 -out %s' % (tempQuery,
-                                                       tempRef,
-                                                       tempOut)
-        p = subprocess.Popen( cline.split() )
-        stdout, stderr = p.communicate()
-        # Parse and return the best hit and remove temp files
-        bestHit = cls.readBestBlasrHit(tempOut)
-        os.remove(tempRef)
-        os.remove(tempQuery)
-        os.remove(tempOut)
-        return bestHit
-
-    @classmethod
-    def readBestBlasrHit(cls, blasrOutput):
-        with open(blasrOutput, 'r') as handle:
-            csvReader = csv.reader(handle, delimiter=' ')
-            blasrHits = list( map(cls.BlasrRecord._make, csvReader) )
-        return blasrHits[0]
+    def findExactMatch(cls, fastqRecord, unalignedRecord):
+        """
+        Locate an ungapped sequence directly within either strand of the
+        read it came from, returning an equivalent hit or None
+        """
+        query = unalignedRecord.sequence
+        forward = fastqRecord.sequence
+        for strand, target in [('0', forward), 
+                               ('1', cls.reverseComplement(forward))]:
+            start = target.find( query )
+            if start < 0:
+                continue
+            return cls.BlasrRecord(unalignedRecord.name, fastqRecord.name,
+                                   '0', strand, '0', '100.0',
+                                   str(start), str(start + len(query)), str(len(target)),
+                                   '0', str(len(query)), str(len(query)), '0')
+        return None
 
     @classmethod
     def trimFastqRecord(cls, fastqRecord, blasrHit):
@@ -187,18 +178,16 @@ class QualityAligner(object):
         return trimmedRecord
 
     @classmethod
-    def addGappedQualities(cls, fastqRecord, seqParts, alignedRecord):
-        qualities = ''
-        pos = 0
-        for part in seqParts:
-            if type(part) is int:
-                qualities += '!' * part
-            else:
-                qualities += fastqRecord.qualityString[pos:pos+len(part)]
-                pos += len(part)
+    def addGappedQualities(cls, fastqRecord, gapMask, alignedRecord):
+        """
+        Scatter the trimmed QVs into the non-gap columns of the alignment
+        """
+        qualities = np.empty( len(gapMask), dtype=np.uint8 )
+        qualities.fill( cls.GAP_QV )
+        qualities[~gapMask] = np.frombuffer( fastqRecord.qualityString, dtype=np.uint8 )
         alignedRecord = FastqRecord(alignedRecord.name,
                                     alignedRecord.sequence,
-                                    qualityString=qualities) 
+                                    qualityString=qualities.tostring()) 
         return alignedRecord
 
     ####################
@@ -207,50 +196,49 @@ class QualityAligner(object):
 
     def run(self):
         self.parseFastqData()
-        self.alignFastqData()
-        self.writeFastqData()
+        alignedFastqs = self.alignFastqData()
+        self.writeFastqData( alignedFastqs )
+        self.sequenceData.close()
         return self.output
 
     def parseFastqData(self):
-        self.sequenceData = {}
-        log.info('Reading QV data from "%s"...' % self.fastq)
-        counter = 0
-        for record in FastqReader( self.fastq ):
-            zmw = self.getZmw( record )
-            self.sequenceData[zmw] = record
-            counter += 1
-        log.info('A total of %s Fastq records were read into memory' % counter)
+        log.info('Indexing QV data from "%s"...' % self.fastq)
+        self.sequenceData = FastqIndex( self.fastq )
+        log.info('A total of %s Fastq records were indexed' % len(self.sequenceData))
 
     def alignFastqData(self):
-        self.alignedFastqs = []
+        """
+        Combine each aligned record with its QVs, streaming the results
+        so that only one record is held in memory at a time
+        """
         log.info('Combining data from the Aligned Fasta and Fastq files...')
         counter = 0
         for record in FastaReader( self.aligned ):
-            zmw = self.getZmw( record )
-            try:
-                fastqRecord = self.sequenceData[zmw]
-            except KeyError: 
-                raise KeyError("No quality data found for '%s'!" % zmw)
-            seqParts = self.getSeqParts(record)
-            unalignedRecord = self.createUnalignedRecord(seqParts, zmw)
-            blasrHit = self.runBlasr(fastqRecord, unalignedRecord)
-            trimmedFastq = self.trimFastqRecord(fastqRecord, blasrHit)
-            try:
-                assert unalignedRecord.sequence == trimmedFastq.sequence
-            except AssertionError:
-                raise ValueError("Sequences don't match for '%s'" % zmw)
-            updatedRecord = self.addGappedQualities(trimmedFastq, seqParts, record)
             counter += 1
-            self.alignedFastqs.append(updatedRecord)
+            yield self.alignFastqRecord( record )
         log.info('A total of %s aligned Fastq records were created' % counter)
 
-    def writeFastqData(self):
+    def alignFastqRecord(self, record):
+        zmw = self.getZmw( record )
+        try:
+            fastqRecord = self.sequenceData[zmw]
+        except KeyError: 
+            raise KeyError("No quality data found for '%s'!" % zmw)
+        unalignedRecord = self.createUnalignedRecord(record, zmw)
+        # Only sequences found verbatim in their reads can be given QVs
+        hit = self.findExactMatch( fastqRecord, unalignedRecord )
+        if hit is None:
+            raise ValueError("Sequences don't match for '%s'" % zmw)
+        trimmedFastq = self.trimFastqRecord(fastqRecord, hit)
+        gapMask = self.getGapMask(record)
+        return self.addGappedQualities(trimmedFastq, gapMask, record)
+
+    def writeFastqData(self, alignedFastqs):
         log.info('Writing aligned Fastq data out to "%s"' % self.output)
         with FastqWriter( self.output ) as handle:
-            for alignedFastq in self.alignedFastqs:
+            for alignedFastq in alignedFastqs:
                 handle.writeRecord( alignedFastq )
 
-
 if __name__ == '__main__':
     aligner = QualityAligner()
     aligner.run()
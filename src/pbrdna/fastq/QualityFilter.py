@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 
 from pbcore.io.FastqIO import FastqReader, FastqWriter
-from numpy import mean, log10
+from pbrdna.fastq.utils import predicted_accuracies, batch_records
 
 MIN_ACCURACY = 0.99
 
@@ -15,21 +15,16 @@ class QualityFilter( object ):
         self.min_accuracy = min_accuracy
 
     def __call__(self):
-        for fastq in self.input_reader:
-            if predicted_accuracy(fastq) >= self.min_accuracy:
-                self.output_writer.writeRecord( fastq )
+        for batch in batch_records( self.input_reader ):
+            accuracies = predicted_accuracies( batch )
+            for fastq, accuracy in zip(batch, accuracies):
+                if accuracy >= self.min_accuracy:
+                    self.output_writer.writeRecord( fastq )
 
 
 # Utility Functions
-def quality_to_p(qv):
-    return 1-(10**(-1*qv/10.0))
-
-def convert_quality(qv_scores):
-    return [quality_to_p(qv) for qv in qv_scores]
-
 def predicted_accuracy(record):
-    p_scores = convert_quality( record.quality )
-    return round(mean(p_scores), 4)
+    return predicted_accuracies( [record] )[0]
 
 
 if __name__ == '__main__':
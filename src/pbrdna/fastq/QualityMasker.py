@@ -2,7 +2,7 @@ import sys
 import os
 import logging
 
-from numpy import where
+import numpy as np
 
 from pbcore.io.FastqIO import FastqReader, FastqWriter
 
@@ -14,6 +14,7 @@ class QualityMasker(object):
     """
     MIN_QV = 15
     MIN_BASES = 1000
+    MASK_CHAR = ord('-')
 
     ##########################
     # Initialization Methods #
@@ -58,7 +59,7 @@ class QualityMasker(object):
             self.output = outputFile
         # If no minimum QV is set, use the default value
         if minQv is None:
-            log.info('No minimum QV specified, using default value %s' % self.minQV)
+            log.info('No minimum QV specified, using default value %s' % self.MIN_QV)
             self.minQv = self.MIN_QV
         else:
             log.info('Minimum QV specified as %s' % minQv)
@@ -81,35 +82,30 @@ class QualityMasker(object):
     ####################
 
     def maskFastqRecord(self, fastqRecord):
-        indicesToMask = where(fastqRecord.quality < self.minQv)[0]
-        maskedSequence = ['-' if any(indicesToMask == pos) else base
-                              for pos, base in enumerate(fastqRecord.sequence)]
-        fastqRecord.sequence = ''.join(maskedSequence)
+        sequence = np.frombuffer( fastqRecord.sequence, dtype=np.uint8 ).copy()
+        sequence[fastqRecord.quality < self.minQv] = self.MASK_CHAR
+        fastqRecord.sequence = sequence.tostring()
         return fastqRecord
 
     def run(self):
-        self.parseFastqData()
-        self.maskFastqData()
-        self.writeFastqData()
+        fastqRecords = self.parseFastqData()
+        maskedFastqs = self.maskFastqData( fastqRecords )
+        self.writeFastqData( maskedFastqs )
         return self.output
 
     def parseFastqData(self):
-        self.fastqData = []
-        log.info('Reading Fastq data into memory from %s...' % self.fastq)
-        for fastqRecord in FastqReader( self.fastq ):
-            self.fastqData.append( fastqRecord )
+        log.info('Streaming Fastq data from %s...' % self.fastq)
+        return FastqReader( self.fastq )
 
-    def maskFastqData(self):
-        self.maskedFastqs = []
+    def maskFastqData(self, fastqRecords):
         log.info('Masking low quality bases')
-        for fastqRecord in self.fastqData:
-            maskedFastq = self.maskFastqRecord( fastqRecord )
-            self.maskedFastqs.append( maskedFastq )
+        for fastqRecord in fastqRecords:
+            yield self.maskFastqRecord( fastqRecord )
 
-    def writeFastqData(self):
+    def writeFastqData(self, fastqRecords):
         log.info('Writing the masked Fastq data out to "%s"...' % self.output)
         with FastqWriter( self.output ) as writer: 
-            for fastqRecord in self.maskedFastqs:
+            for fastqRecord in fastqRecords:
                 writer.writeRecord( fastqRecord )
 
 if __name__ == '__main__':
@@ -2,15 +2,20 @@
 
 import sys
 import os
-import re
 import logging
 
-from numpy import where
+from itertools import islice
+from multiprocessing import Pool
 
-from pbrdna.io.FastqIO import FastqReader, FastqRecord, FastqWriter
+import numpy as np
+
+from pbcore.io.FastqIO import FastqReader, FastqRecord, FastqWriter
+from pbrdna.fastq.utils import ascii_to_qvs, batch_records
 
 MIN_QV = None
 MIN_LENGTH = 100
+WINDOW_SIZE = 10
+NPROC = 1
 
 log = logging.getLogger(__name__)
 
@@ -25,11 +30,14 @@ class QualityTrimmer(object):
     def __init__(self, fastqFile=None, 
                        outputFile=None, 
                        minQv=None, 
-                       minLength=None):
+                       minLength=None,
+                       windowSize=None,
+                       nproc=None):
         if fastqFile is None:
             self.initializeFromArgs()
         else:
-            self.initializeFromCall(fastqFile, outputFile, minQv, minLength)
+            self.initializeFromCall(fastqFile, outputFile, minQv, minLength,
+                                    windowSize, nproc)
         self.validateSettings()
 
     def initializeFromArgs(self):
@@ -40,20 +48,29 @@ class QualityTrimmer(object):
                             help="File of FASTQ sequence data to align")
         parser.add_argument('-q', '--minimum_qv', metavar='INT',
                             type=int, default=MIN_QV, dest='minQv',
-                            help="Minimum QV to leave un-masked")
+                            help="Minimum mean QV of the windows left on " + \
+                                 "either end of each read")
+        parser.add_argument('-w', '--window_size', metavar='INT',
+                            type=int, default=WINDOW_SIZE, dest='windowSize',
+                            help="Size of the sliding window used for " + \
+                                 "quality trimming")
         parser.add_argument('-l', '--minimum_length', metavar='INT',
                             type=int, default=MIN_LENGTH, dest='minLength',
                             help="Minimum length to require " + \
                                  "of all post-masked bases")
+        parser.add_argument('-n', '--num_processes', metavar='INT',
+                            type=int, default=NPROC, dest='nproc',
+                            help="Number of processes to trim with")
         parser.add_argument('-o', '--output', metavar='OUTPUT_FILE',
                             default=sys.stdout,
                             help="Output file for the aligned FASTQ")
         args = parser.parse_args()
         self.__dict__.update( vars(args) )
 
-    def initializeFromCall(self, fastqFile, outputFile, minQv):
+    def initializeFromCall(self, fastqFile, outputFile, minQv, minLength,
+                                 windowSize, nproc):
         self.fastq = fastqFile
-        log.info('Creating a QualityMasker for "%s"' % self.fastq)
+        log.info('Creating a QualityTrimmer for "%s"' % self.fastq)
         # If no output file is set, default to STDOUT
         if outputFile is None:
             self.output = sys.stdout
@@ -61,11 +78,14 @@ class QualityTrimmer(object):
             self.output = outputFile
         # If no minimum QV is set, use the default value
         if minQv is None:
-            log.info('No minimum QV specified, using default value %s' % self.minQV)
+            log.info('No minimum QV specified, using default value %s' % MIN_QV)
             self.minQv = MIN_QV
         else:
             log.info('Minimum QV specified as %s' % minQv)
             self.minQv = minQv
+        self.minLength = MIN_LENGTH if minLength is None else minLength
+        self.windowSize = WINDOW_SIZE if windowSize is None else windowSize
+        self.nproc = NPROC if nproc is None else nproc
         log.info('No log-file set for this process')
 
     def validateSettings(self):
@@ -74,71 +94,97 @@ class QualityTrimmer(object):
             assert ext in ['.fq', '.fastq']
         except:
             raise ValueError("'%s' is not a recognized FASTQ file!" % self.fastq)
-        #try:
-        #    assert self.minQv > 0
-        #except:
-        #    raise ValueError("Minimum QV must be > 0!")
+        try:
+            assert self.windowSize > 0
+        except:
+            raise ValueError("Window size must be > 0!")
 
     ####################
     # Instance Methods #
     ####################
 
-    def parseFastqData(self):
-        self.fastqData = []
-        log.info('Reading Fastq data into memory from %s...' % self.fastq)
-        for fastqRecord in FastqReader( self.fastq ):
-            self.fastqData.append( fastqRecord )
-
-    def trimFastqRecord(self, fastqRecord):
-        # First identify any 5' N bases to trim
-        if fastqRecord.sequence.startswith('N'):
-            start = len( re.findall('^N+', fastqRecord.sequence)[0] )
-        else:
-            start = 0
-        # Second identify any 3' N bases to trim
-        if fastqRecord.sequence.endswith('N'):
-            end = len(fastqRecord.sequence) - len( re.findall('N+$', fastqRecord.sequence)[0] )
-        else:
-            end = len(fastqRecord.sequence)
-        # Third trim any non-N bases of low quality on the ends
-        if self.minQv is not None:
-            pass
-        # Finally, subset the Fastq to the identified positions
-        if start == 0 and end == len(fastqRecord.sequence):
-            return fastqRecord
+    def trimFastqData(self, fastqRecords):
+        """
+        Trim and length-filter batches of records, in a worker pool if
+        more than one process was requested, yielding the survivors in order
+        """
+        log.info('Trimming low quality bases...')
+        tasks = ( ([(r.name, r.sequence, r.qualityString) for r in batch],
+                   self.minQv, self.windowSize, self.minLength)
+                  for batch in batch_records( fastqRecords ) )
+        if self.nproc > 1:
+            pool = Pool( self.nproc )
+            try:
+                # Only hand the pool a few batches at a time to bound memory
+                while True:
+                    taskBlock = list( islice( tasks, 2 * self.nproc ) )
+                    if not taskBlock:
+                        break
+                    for trimmed in pool.map( trim_fastq_batch, taskBlock ):
+                        for record in trimmed:
+                            yield record
+            finally:
+                pool.close()
+                pool.join()
         else:
-            return FastqRecord(fastqRecord.name,
-                               fastqRecord.sequence[start:end],
-                               qualityString=fastqRecord.qualityString[start:end])
+            for task in tasks:
+                for record in trim_fastq_batch( task ):
+                    yield record
 
-    def trimFastqData(self):
-        self.trimmedFastqs = []
-        log.info('Trimming low quality bases...')
-        for fastqRecord in self.fastqData:
-            trimmedFastq = self.trimFastqRecord( fastqRecord )
-            self.trimmedFastqs.append( trimmedFastq )
-
-    def filterFastqData(self):
-        self.filteredFastqs = []
-        log.info('Filtering out short and empty sequences...')
-        for fastqRecord in self.trimmedFastqs:
-            if len(fastqRecord.sequence) < self.minLength:
-                continue
-            self.filteredFastqs.append( fastqRecord )
-
-    def writeFastqData(self):
+    def writeFastqData(self, trimmedRecords):
         log.info('Writing the trimmed FASTQ data out to "%s"...' % self.output)
         with FastqWriter( self.output ) as writer: 
-            for fastqRecord in self.filteredFastqs:
-                writer.writeRecord( fastqRecord )
+            for name, sequence, qualityString in trimmedRecords:
+                writer.writeRecord( FastqRecord(name, sequence,
+                                                qualityString=qualityString) )
 
     def __call__(self):
-        self.parseFastqData()
-        self.trimFastqData()
-        self.filterFastqData()
-        self.writeFastqData()
+        log.info('Streaming Fastq data from %s...' % self.fastq)
+        fastqRecords = FastqReader( self.fastq )
+        self.writeFastqData( self.trimFastqData( fastqRecords ) )
         return self.output
 
+def trim_fastq_batch( task ):
+    """
+    Trim a batch of (name, sequence, qualityString) tuples, dropping
+    any that end up shorter than the minimum length
+    """
+    records, minQv, windowSize, minLength = task
+    trimmed = []
+    for name, sequence, qualityString in records:
+        start, end = trim_positions( sequence, ascii_to_qvs( qualityString ),
+                                     minQv, windowSize )
+        if end - start < minLength:
+            continue
+        trimmed.append( (name, sequence[start:end], qualityString[start:end]) )
+    return trimmed
+
+def trim_positions( sequence, quality, minQv, windowSize ):
+    """
+    Find the span of a read left after removing any N's from either end,
+    followed by any low-quality windows
+    """
+    start = len(sequence) - len(sequence.lstrip('N'))
+    end = start + len(sequence[start:].rstrip('N'))
+    if minQv is None or end <= start:
+        return (start, end)
+    windowStart, windowEnd = quality_window_span( quality[start:end],
+                                                  minQv, windowSize )
+    return (start + windowStart, start + windowEnd)
+
+def quality_window_span( quality, minQv, windowSize ):
+    """
+    Slide a window along a QV array and return the span from the first
+    to the last window whose mean QV is at least minQv
+    """
+    windowSize = min(windowSize, len(quality))
+    sums = np.cumsum( np.concatenate( ([0], quality) ), dtype=np.int64 )
+    windowSums = sums[windowSize:] - sums[:-windowSize]
+    passing = np.flatnonzero( windowSums >= minQv * windowSize )
+    if not len(passing):
+        return (0, 0)
+    return (int(passing[0]), int(passing[-1]) + windowSize)
+
 if __name__ == '__main__':
     trimmer = QualityTrimmer()
     trimmer()
@@ -1,42 +1,89 @@
 #! /usr/bin/env python
 
 import logging
-from numpy import mean
+from multiprocessing import Pool
 from pbcore.io.FastqIO import FastqReader, FastqWriter
-from pbrdna.arguments import args, MIN_ACCURACY
+from pbrdna.arguments import args, MIN_ACCURACY, NPROC
+from pbrdna.fastq.utils import (predicted_accuracies, mean_accuracies, ascii_to_qvs,
+                                batch_records, fastq_byte_ranges, read_fastq_range)
+from pbrdna.utils import merge_files
 
 ACCURACY = getattr(args, 'min_accuracy', MIN_ACCURACY)
+PROCESSES = getattr(args, 'nproc', NPROC)
+
+# Split the input more finely than the process count to balance the load
+CHUNKS_PER_PROCESS = 4
 
 log = logging.getLogger()
 
-def quality_filter(input_fastq, output_fastq, min_accuracy=ACCURACY):
+def quality_filter(input_fastq, output_fastq, min_accuracy=ACCURACY, nproc=PROCESSES):
     """
     Filter out sequences below a threshold of predicted accuracy
     """
     log.info("Filtering sequences below {0}% predicted accuracy".format(100*min_accuracy))
-    seq_count = 0
-    pass_count = 0
-    with FastqWriter( output_fastq ) as writer:
-        for record in FastqReader( input_fastq ):
-            seq_count += 1
-            if predicted_accuracy(record) >= min_accuracy:
-                pass_count += 1
-                writer.writeRecord( record )
+    if nproc > 1:
+        seq_count, pass_count = parallel_quality_filter(input_fastq, output_fastq,
+                                                        min_accuracy, nproc)
+    else:
+        seq_count, pass_count = serial_quality_filter(input_fastq, output_fastq,
+                                                      min_accuracy)
     percentage = round(100.0*pass_count/seq_count, 4)
     log.info("{0} sequences of {1} ({2}%) passed filtering".format(pass_count,
                                                                    seq_count,
                                                                    percentage))
 
-# Utility Functions
-def predicted_accuracy(record):
-    p_scores = convert_quality( record.quality )
-    return round(mean(p_scores), 4)
+def serial_quality_filter(input_fastq, output_fastq, min_accuracy):
+    seq_count = 0
+    pass_count = 0
+    with FastqWriter( output_fastq ) as writer:
+        for batch in batch_records( FastqReader( input_fastq ) ):
+            seq_count += len(batch)
+            accuracies = predicted_accuracies( batch )
+            for record, accuracy in zip(batch, accuracies):
+                if accuracy >= min_accuracy:
+                    pass_count += 1
+                    writer.writeRecord( record )
+    return seq_count, pass_count
+
+def parallel_quality_filter(input_fastq, output_fastq, min_accuracy, nproc):
+    """
+    Filter record-aligned byte ranges of the input in separate worker
+    processes, then concatenate their outputs in the original order
+    """
+    ranges = fastq_byte_ranges( input_fastq, nproc * CHUNKS_PER_PROCESS )
+    log.info("Filtering {0} chunks of the input with {1} processes".format(len(ranges), nproc))
+    tasks = []
+    for i, (start, end) in enumerate( ranges ):
+        shard_file = '%s.%s.part' % (output_fastq, i)
+        tasks.append( (input_fastq, shard_file, start, end, min_accuracy) )
+    pool = Pool( nproc )
+    try:
+        counts = pool.map( filter_fastq_range, tasks )
+    finally:
+        pool.close()
+        pool.join()
+    merge_files( [task[1] for task in tasks], output_fastq, remove=True )
+    seq_count = sum( c[0] for c in counts )
+    pass_count = sum( c[1] for c in counts )
+    return seq_count, pass_count
 
-def convert_quality(qv_scores):
-    return [quality_to_p(qv) for qv in qv_scores]
+def filter_fastq_range( task ):
+    input_fastq, shard_file, start, end, min_accuracy = task
+    seq_count = 0
+    pass_count = 0
+    with open( shard_file, 'wb' ) as output:
+        for batch in batch_records( read_fastq_range( input_fastq, start, end ) ):
+            seq_count += len(batch)
+            accuracies = mean_accuracies( [ascii_to_qvs( q ) for h, s, q in batch] )
+            for (header, sequence, quality), accuracy in zip(batch, accuracies):
+                if accuracy >= min_accuracy:
+                    pass_count += 1
+                    output.write( '%s\n%s\n+\n%s\n' % (header, sequence, quality) )
+    return seq_count, pass_count
 
-def quality_to_p(qv):
-    return 1-(10**(-1*qv/10.0))
+# Utility Functions
+def predicted_accuracy(record):
+    return predicted_accuracies( [record] )[0]
 
 
 if __name__ == '__main__':
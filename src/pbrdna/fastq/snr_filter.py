@@ -3,10 +3,15 @@
 __author__ = 'bbowman@pacificbiosciences.com'
 
 import logging
-from pbcore.io.BasH5IO import BasH5Collection
+
+import numpy as np
+
 from pbcore.io.FastqIO import FastqReader, FastqWriter
 from pbrdna.arguments import args, MIN_SNR
+from pbrdna.fastq.utils import batch_records
+from pbrdna.io.zmw_metrics import load_zmw_metrics
 from pbrdna.log import initialize_logger
+from pbrdna.utils import read_raw_data_files, get_movie_name
 
 SNR = getattr(args, 'min_snr', MIN_SNR)
 
@@ -19,22 +24,64 @@ def snr_filter(input_fastq, raw_data_file, output_fastq, min_snr=SNR):
     log.info("Filtering sequences below {0} Signal-To-Noise Ratio".format(min_snr))
     seq_count = 0
     pass_count = 0
-    raw_data = BasH5Collection( raw_data_file )
+    snr_table = load_snr_table( raw_data_file )
     with FastqWriter( output_fastq ) as writer:
-        for record in FastqReader( input_fastq ):
-            seq_count += 1
-            zmw_name = '/'.join( record.name.strip().split('/')[:2] )
-            zmw = raw_data[zmw_name]
-            zmw_snr = min( zmw.zmwMetric("HQRegionSNR") )
-            print zmw_name, zmw_snr
-            if zmw_snr >= min_snr:
-                pass_count += 1
-                writer.writeRecord( record )
+        for batch in batch_records( FastqReader( input_fastq ) ):
+            seq_count += len(batch)
+            snrs = lookup_snrs( snr_table, [record.name for record in batch] )
+            for record, zmw_snr in zip(batch, snrs):
+                if zmw_snr >= min_snr:
+                    pass_count += 1
+                    writer.writeRecord( record )
     percentage = round(100.0*pass_count/seq_count)
     log.info("{0} sequences of {1} ({2}%) passed filtering".format(pass_count,
                                                                    seq_count,
                                                                    percentage))
 
+def load_snr_table( raw_data_file ):
+    """
+    Load the minimum HQRegionSNR of every ZMW, as arrays sorted by
+    hole number for each movie
+    """
+    movies = {}
+    for raw_file in read_raw_data_files( raw_data_file ):
+        metrics = load_zmw_metrics( raw_file )
+        movie = get_movie_name( raw_file )
+        movies.setdefault( movie, [] ).append( (metrics.holeNumber,
+                                                metrics.hqRegionSnr.min( axis=1 )) )
+    snr_table = {}
+    for movie, parts in movies.iteritems():
+        hole_numbers = np.concatenate( [p[0] for p in parts] )
+        snrs = np.concatenate( [p[1] for p in parts] )
+        order = np.argsort( hole_numbers )
+        snr_table[movie] = (hole_numbers[order], snrs[order])
+    return snr_table
+
+def lookup_snrs( snr_table, read_names ):
+    """
+    Resolve a batch of read names to their ZMWs' minimum SNRs
+    """
+    zmws = [name.strip().split('/')[:2] for name in read_names]
+    snrs = np.empty( len(zmws) )
+    by_movie = {}
+    for i, (movie, hole_number) in enumerate( zmws ):
+        by_movie.setdefault( movie, [] ).append( (i, int(hole_number)) )
+    for movie, reads in by_movie.iteritems():
+        indices = np.array( [r[0] for r in reads] )
+        hole_numbers = np.array( [r[1] for r in reads] )
+        try:
+            table_holes, table_snrs = snr_table[movie]
+        except KeyError:
+            raise KeyError('No raw data found for movie "%s"' % movie)
+        positions = np.minimum( np.searchsorted( table_holes, hole_numbers ),
+                                len(table_holes) - 1 )
+        missing = table_holes[positions] != hole_numbers
+        if missing.any():
+            zmw = '%s/%s' % (movie, hole_numbers[missing][0])
+            raise KeyError('No raw data found for ZMW "%s"' % zmw)
+        snrs[indices] = table_snrs[positions]
+    return snrs
+
 
 if __name__ == '__main__':
     import sys
@@ -44,5 +91,5 @@ if __name__ == '__main__':
     output_file = sys.argv[3]
     min_snr = float(sys.argv[4])
 
-    initialize_logger()
-    snr_filter(input_file, raw_data, output_file, min_snr)
\ No newline at end of file
+    initialize_logger( log, stream=sys.stdout )
+    snr_filter(input_file, raw_data, output_file, min_snr)
\ No newline at end of file
@@ -1,14 +1,21 @@
+import os
 import numpy as np
 
+from itertools import islice
+
 from pbcore.io.FastqIO import FastqRecord
 
+# Probability of a base-calling error for every possible QV
+QV_ERROR_TABLE = 10 ** (-np.arange(256) / 10.0)
+
+BATCH_SIZE = 10000
+
 def meanP( record ):
     try:
         assert isinstance(record, FastqRecord)
     except:
         raise TypeError("Record is not a FastqRecord!")
-    pValues = [10**-(i/10) for i in np.float32(record.quality)]
-    return sum(pValues) / len(pValues)
+    return mean_error( record.quality )
 
 def meanPQv( record ):
     try:
@@ -19,3 +26,94 @@ def meanPQv( record ):
 
 def pValueToQv( pValue ):
     return -10 * np.log10( pValue )
+
+def error_probabilities( qualities ):
+    """
+    Look up the error probability of each QV in an array
+    """
+    return QV_ERROR_TABLE[ np.asarray( qualities, dtype=np.uint8 ) ]
+
+def mean_error( qualities ):
+    return error_probabilities( qualities ).mean()
+
+def mean_errors( quality_arrays ):
+    """
+    Calculate the mean error probability of a whole batch of QV arrays
+    at once, returning NaN for any empty array
+    """
+    lengths = np.array( [len(q) for q in quality_arrays], dtype=np.int64 )
+    sums = np.zeros( len(lengths) )
+    filled = lengths > 0
+    if filled.any():
+        errors = error_probabilities( np.concatenate( quality_arrays ) )
+        starts = np.cumsum( lengths ) - lengths
+        sums[filled] = np.add.reduceat( errors, starts[filled] )
+    with np.errstate( invalid='ignore', divide='ignore' ):
+        return sums / lengths
+
+def mean_accuracies( quality_arrays ):
+    return np.round( 1.0 - mean_errors( quality_arrays ), 4 )
+
+def predicted_accuracies( records ):
+    """
+    Calculate the mean predicted accuracy of a batch of FastqRecords
+    """
+    return mean_accuracies( [record.quality for record in records] )
+
+def ascii_to_qvs( qualityString ):
+    return np.frombuffer( qualityString, dtype=np.uint8 ) - 33
+
+def batch_records( records, size=BATCH_SIZE ):
+    records = iter( records )
+    while True:
+        batch = list( islice( records, size ) )
+        if not batch:
+            return
+        yield batch
+
+def fastq_byte_ranges( fastq_file, count ):
+    """
+    Split a 4-line FASTQ file into at most "count" record-aligned byte ranges
+    """
+    size = os.path.getsize( fastq_file )
+    offsets = [0]
+    with open( fastq_file, 'rb' ) as handle:
+        for i in range(1, count):
+            offset = find_record_start( handle, size * i // count )
+            if offsets[-1] < offset < size:
+                offsets.append( offset )
+    offsets.append( size )
+    return zip( offsets[:-1], offsets[1:] )
+
+def find_record_start( handle, offset ):
+    """
+    Find the first FASTQ record starting at or after an offset.  A '@' may
+    also begin a quality line, so the third line must also start with '+'
+    """
+    handle.seek( offset )
+    if offset > 0:
+        handle.readline()
+    while True:
+        position = handle.tell()
+        lines = [handle.readline() for i in range(3)]
+        if not lines[2]:
+            return os.fstat( handle.fileno() ).st_size
+        if lines[0].startswith('@') and lines[2].startswith('+'):
+            return position
+        handle.seek( position )
+        handle.readline()
+
+def read_fastq_range( fastq_file, start, end ):
+    """
+    Iterate over the raw (header, sequence, quality) lines of the 4-line
+    FASTQ records that start within a byte range
+    """
+    with open( fastq_file, 'rb' ) as handle:
+        handle.seek( start )
+        position = start
+        while position < end:
+            lines = [handle.readline() for i in range(4)]
+            if not lines[0]:
+                return
+            position += sum( len(line) for line in lines )
+            yield (lines[0].rstrip(), lines[1].rstrip(), lines[3].rstrip())
@@ -32,7 +32,8 @@ import sys
 import logging
 
 from pbcore.io.BasH5Reader import BasH5Reader
-from pbcore.io.FastqIO import FastqRecord, FastqWriter
+
+from pbrdna.io.FastqIO import BufferedFastqWriter, qvs_to_ascii, COMPRESSION_CHOICES
 
 log = logging.getLogger(__name__)
 
@@ -45,11 +46,11 @@ class BasH5Extractor(object):
     # Initialization Methods #
     ##########################
 
-    def __init__(self, input_file=None, output_file=None):
+    def __init__(self, input_file=None, output_file=None, compression=None):
         if input_file is None:
             self.initialize_from_args()
         else:
-            self.initialize_from_call(input_file, output_file)
+            self.initialize_from_call(input_file, output_file, compression)
         self.validate_settings()
         self.initialize_readers()
 
@@ -60,6 +61,8 @@ class BasH5Extractor(object):
                             help="BasH5 or FOFN to extract from")
         parser.add_argument('-o', '--output', default=sys.stdout,
                             help="Specify a file to output the data to")
+        parser.add_argument('-z', '--compression', choices=COMPRESSION_CHOICES,
+                            help="Compress the output with gzip or bgzip")
         group = parser.add_mutually_exclusive_group(required=True)
         group.add_argument('--subreads',  action='store_true',
                             help="Output sequences from individual subreads")
@@ -68,12 +71,13 @@ class BasH5Extractor(object):
         args = parser.parse_args()
         self.__dict__.update( vars(args) )
 
-    def initialize_from_call(self, input_file, output_file):
+    def initialize_from_call(self, input_file, output_file, compression):
         self.input_file = input_file
         if output_file is None:
             self.output = sys.stdout
         else:
             self.output = output_file
+        self.compression = compression
 
     def validate_settings(self):
         if self.input_file.endswith('.bas.h5') or \
@@ -117,21 +121,20 @@ class BasH5Extractor(object):
     def writeCcsFastq(cls, basH5Reader, fastqWriter):
         log.info('Writing Fastq CCS reads from "%s"...' % basH5Reader.movieName)
         for zmw in basH5Reader:
-            if zmw.ccsRead:
-                fastqRecord = FastqRecord(zmw.ccsRead.readName,
-                                          zmw.ccsRead.basecalls(),
-                                          zmw.ccsRead.QualityValue())
-                fastqWriter.writeRecord( fastqRecord )
+            ccsRead = zmw.ccsRead
+            if ccsRead:
+                fastqWriter.write(ccsRead.readName,
+                                  ccsRead.basecalls(),
+                                  qvs_to_ascii( ccsRead.QualityValue() ))
 
     @classmethod
     def writeSubreadFastq(cls, basH5Reader, fastqWriter):
         log.info('Writing Fastq subreads from "%s"...' % basH5Reader.movieName)
         for zmw in basH5Reader:
             for subread in zmw.subreads():
-                fastqRecord = FastqRecord(subread.readName,
-                                          subread.basecalls(),
-                                          subread.QualityValue())
-                fastqWriter.writeRecord( fastqRecord )
+                fastqWriter.write(subread.readName,
+                                  subread.basecalls(),
+                                  qvs_to_ascii( subread.QualityValue() ))
 
     ####################
     # Instance Methods #
@@ -139,13 +142,13 @@ class BasH5Extractor(object):
 
     def outputCcsFastq(self):
         log.info('Parsing Fastq CCS reads from input BAS.H5 files')
-        with FastqWriter(self.output) as writer:
+        with BufferedFastqWriter(self.output, self.compression) as writer:
             for reader in self.bash5_readers:
                 self.writeCcsFastq( reader, writer )
 
     def outputSubreadFastq(self):
         log.info('Parsing Fastq subreads from input BAS.H5 files')
-        with FastqWriter(self.output) as writer:
+        with BufferedFastqWriter(self.output, self.compression) as writer:
             for reader in self.bash5_readers:
                 self.writeSubreadFastq( reader, writer )
 
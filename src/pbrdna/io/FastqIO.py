@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+
+__author__ = 'bbowman@pacificbiosciences.com'
+
+import gzip
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+COMPRESSION_CHOICES = ['gzip', 'bgzip']
+
+def qvs_to_ascii( qvs ):
+    """
+    Convert an array of QVs to a Sanger-encoded quality string
+    """
+    return (np.minimum( qvs, 93 ) + 33).astype( np.uint8 ).tostring()
+
+class BufferedFastqWriter(object):
+    """
+    A FASTQ writer that formats records straight into a reusable buffer
+    and flushes it to the output in large blocks
+    """
+    BUFFER_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, output, compression=None, bufferSize=None):
+        self.bufferSize = bufferSize or self.BUFFER_SIZE
+        self.buffer = bytearray()
+        self.openOutput( output, compression )
+
+    def openOutput(self, output, compression):
+        if compression is not None and compression not in COMPRESSION_CHOICES:
+            raise ValueError('Compression must be one of %s!' % COMPRESSION_CHOICES)
+        # File-like outputs (i.e. STDOUT) are wrapped but never closed
+        if hasattr(output, 'write'):
+            self.ownsOutput = False
+            self.output = output
+            fileobj = output
+            filename = None
+        else:
+            self.ownsOutput = True
+            self.output = None
+            fileobj = None
+            filename = output
+        if compression == 'gzip':
+            self.file = gzip.GzipFile( filename, 'wb', fileobj=fileobj )
+        elif compression == 'bgzip':
+            try:
+                from Bio import bgzf
+            except ImportError:
+                raise ImportError('BGZF output requires Biopython')
+            self.file = bgzf.BgzfWriter( filename, 'wb', fileobj=fileobj )
+        elif fileobj is not None:
+            self.file = fileobj
+        else:
+            self.file = open( filename, 'wb' )
+
+    def write(self, name, sequence, qualityString):
+        self.buffer += '@%s\n%s\n+\n%s\n' % (name, sequence, qualityString)
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+
+    def writeRecord(self, record):
+        self.write( record.name, record.sequence, record.qualityString )
+
+    def flush(self):
+        if self.buffer:
+            self.file.write( bytes(self.buffer) )
+            del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        if self.file is not self.output:
+            self.file.close()
+        if not self.ownsOutput:
+            self.output.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,7 +1,15 @@
+import os
 import csv
+import logging
 
 from collections import namedtuple, Counter
 
+import numpy as np
+
+from pbrdna.io.sidecar import load_sidecar, save_sidecar
+
+log = logging.getLogger(__name__)
+
 SummaryRecord = namedtuple('SummaryRecord', 'seqname start end nbases ambigs polymer numSeqs')
 
 class SummaryReader(object):
@@ -82,6 +90,102 @@ class SummaryReader(object):
         maximumStart = int(self.start + (margin * length))
         return (maximumStart, minimumEnd)
 
+class ListIndex(object):
+    """
+    An index of the byte offset of each distance line in a Mothur List
+    file, allowing the clusters at one distance to be read lazily
+    without parsing the rest of the file
+    """
+    SUFFIX = '.labelidx.npz'
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, listFile, indexFile=None):
+        self.listFile = listFile
+        if indexFile is None:
+            self.indexFile = listFile + self.SUFFIX
+        else:
+            self.indexFile = indexFile
+        index = load_sidecar( self.indexFile, self.listFile )
+        if index is None:
+            self.buildIndex()
+        else:
+            log.info('Using existing List index "%s"' % self.indexFile)
+            self.loadIndex( index )
+
+    def buildIndex(self):
+        log.info('Building a List index for "%s"...' % self.listFile)
+        self.labels = []
+        self.offsets = []
+        position = 0
+        with open( self.listFile, 'rb' ) as handle:
+            for line in handle:
+                if not line.startswith('label') and line.strip():
+                    self.labels.append( line.split(None, 1)[0] )
+                    self.offsets.append( position )
+                position += len(line)
+        saved = save_sidecar( self.indexFile, self.listFile,
+                              labels=np.array( self.labels ),
+                              offsets=np.array( self.offsets, dtype=np.int64 ) )
+        if saved is None:
+            log.warn('Unable to save the List index "%s"' % self.indexFile)
+
+    def loadIndex(self, index):
+        self.labels = [str(label) for label in index['labels']]
+        self.offsets = [int(offset) for offset in index['offsets']]
+
+    def findOffset(self, label):
+        try:
+            return self.offsets[self.labels.index( label )]
+        except ValueError:
+            raise KeyError( label )
+
+    def iterFields(self, label):
+        """
+        Yield the whitespace-delimited fields of a line a chunk at a time
+        """
+        remainder = ''
+        with open( self.listFile, 'rb' ) as handle:
+            handle.seek( self.findOffset( label ) )
+            while True:
+                chunk = handle.read( self.CHUNK_SIZE )
+                lineEnd = chunk.find('\n')
+                if lineEnd >= 0:
+                    chunk = chunk[:lineEnd]
+                text = remainder + chunk
+                fields = text.split()
+                # Hold back a field that may continue in the next chunk
+                if text and not text[-1].isspace() and lineEnd < 0 and chunk:
+                    remainder = fields.pop()
+                else:
+                    remainder = ''
+                for field in fields:
+                    yield field
+                if lineEnd >= 0 or not chunk:
+                    break
+
+    def clusterCount(self, label):
+        fields = self.iterFields( label )
+        next( fields )
+        return int( next( fields ) )
+
+    def clusters(self, label):
+        """
+        Yield the list of read names in each cluster at a distance
+        """
+        fields = self.iterFields( label )
+        next( fields )
+        clusterCount = int( next( fields ) )
+        found = 0
+        for field in fields:
+            found += 1
+            yield field.split(',')
+        if found != clusterCount:
+            raise ValueError('Expected %s clusters at distance "%s", found %s' % \
+                             (clusterCount, label, found))
+
+    def __len__(self):
+        return len(self.labels)
+
 if __name__ == '__main__':
     parser = SummaryReader()
     print parser.getFullLengthPositions()
@@ -33,71 +33,138 @@ import os
 import sys
 import logging
 
-from pbcore.io.BasH5IO import BasH5Collection
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from pbcore.io.BasH5IO import BasH5Reader
 from pbcore.io.FastqIO import FastqRecord, FastqWriter 
 
-from pbrdna.arguments import args, MIN_LENGTH, MIN_SNR
-from pbrdna.utils import get_output_name
+from pbrdna.arguments import args, MIN_LENGTH, MIN_SNR, NPROC
+from pbrdna.io.zmw_metrics import load_zmw_metrics, ccs_mask, passing_ccs_mask, h5_part_files
+from pbrdna.utils import get_output_name, get_movie_name, read_raw_data_files, merge_files
 
 log = logging.getLogger(__name__)
 
 LENGTH = args.min_length if hasattr(args, 'min_length') else MIN_LENGTH
 SNR = args.min_snr if hasattr(args, 'min_snr') else MIN_SNR
+PROCESSES = args.nproc if hasattr(args, 'nproc') else NPROC
 
 def extract_ccs( input_file, output_file=None,
                              min_length=LENGTH,
-                             min_snr=SNR):
+                             min_snr=SNR,
+                             nproc=PROCESSES):
     """
     Extract CCS reads from an input_file
     """
     output_file = output_file or get_output_name( input_file, 'fastq' )
-    collection = BasH5Collection( input_file )
-    extract_ccs_fastq( collection, output_file, min_length, min_snr )
+    raw_files = sort_by_movie( read_raw_data_files( input_file ) )
+    if nproc > 1:
+        # Split multi-part BasH5 files so each of their parts gets a worker
+        raw_files = [part for raw_file in raw_files
+                          for part in h5_part_files( raw_file )]
+    if nproc > 1 and len(raw_files) > 1:
+        extract_ccs_parallel( raw_files, output_file, min_length, min_snr, nproc )
+    else:
+        extract_ccs_fastq( raw_files, output_file, min_length, min_snr )
     return output_file
 
-def extract_ccs_fastq( collection, output_file, min_length, min_snr ):
+def sort_by_movie( raw_files ):
+    """
+    Group the parts of each movie together, keeping the movies in input order
+    """
+    movies = OrderedDict()
+    for raw_file in raw_files:
+        movies.setdefault( get_movie_name( raw_file ), [] ).append( raw_file )
+    return [raw_file for parts in movies.itervalues() for raw_file in parts]
+
+def extract_ccs_fastq( raw_files, output_file, min_length, min_snr ):
     log.info('Extracting fastq CCS reads from input files')
     log.debug('    min_length: %s' % min_length)
     log.debug('    min_snr: %s' % min_snr)
-    ccs_total = 0
-    pass_total = 0
+    counts = OrderedDict()
     with FastqWriter( output_file ) as writer:
-        for movie in collection.movieNames:
-            log.info('Extracting fastq CCS reads from %s' % os.path.basename(movie))
-            ccs_count = 0
-            pass_count = 0
-            for well in collection[movie].sequencingZmws:
-                zmw = collection[movie][well]
-
-                # Skip non-CCS ZMWs
-                if not zmw.ccsRead:
-                    continue
-                ccs_count += 1
-
-                # Skip short and low-SNR sequences
-                basecalls = zmw.ccsRead.basecalls()
-                if len(basecalls) < min_length:
-                    continue
-                zmw_snr = min( zmw.zmwMetric("HQRegionSNR") )
-                if zmw_snr < min_snr:
-                    continue
-                pass_count += 1
-
-                # Finally write the CCS Fastq to file
-                record = FastqRecord(zmw.ccsRead.readName,
-                                     basecalls,
-                                     zmw.ccsRead.QualityValue())
-                writer.writeRecord( record )
-            percentage = round(100.0*pass_count/ccs_count)
-            log.info("Identified {0} CCS reads, of which {1} ({2}%) passed filter".format(ccs_count,
-                                                                                           pass_count,
-                                                                                           percentage))
-            ccs_total += ccs_count
-            pass_total += pass_count
-    percentage = round(100.0*pass_total/ccs_total)
+        for raw_file in raw_files:
+            ccs_count, pass_count = write_ccs_fastq( raw_file, writer, min_length, min_snr )
+            add_counts( counts, raw_file, ccs_count, pass_count )
+    log_counts( counts )
+
+def extract_ccs_parallel( raw_files, output_file, min_length, min_snr, nproc ):
+    """
+    Extract each raw data file in a separate worker, then merge the
+    per-file FASTQ shards back together in movie order
+    """
+    nproc = min(nproc, len(raw_files))
+    log.info('Extracting fastq CCS reads from input files with %s processes' % nproc)
+    log.debug('    min_length: %s' % min_length)
+    log.debug('    min_snr: %s' % min_snr)
+    tasks = []
+    for i, raw_file in enumerate( raw_files ):
+        shard_file = '%s.%s.part' % (output_file, i)
+        tasks.append( (raw_file, shard_file, min_length, min_snr) )
+    pool = Pool( nproc )
+    try:
+        results = pool.map( extract_ccs_shard, tasks )
+    finally:
+        pool.close()
+        pool.join()
+
+    merge_files( [task[1] for task in tasks], output_file, remove=True )
+    counts = OrderedDict()
+    for raw_file, shard_file, ccs_count, pass_count in results:
+        add_counts( counts, raw_file, ccs_count, pass_count )
+    log_counts( counts )
+
+def extract_ccs_shard( task ):
+    raw_file, shard_file, min_length, min_snr = task
+    with FastqWriter( shard_file ) as writer:
+        ccs_count, pass_count = write_ccs_fastq( raw_file, writer, min_length, min_snr )
+    return (raw_file, shard_file, ccs_count, pass_count)
+
+def write_ccs_fastq( raw_file, writer, min_length, min_snr ):
+    """
+    Write the CCS reads from one BasH5/BaxH5 file that pass filter
+    """
+    log.info('Extracting fastq CCS reads from %s' % os.path.basename(raw_file))
+    # Filter on the bulk-loaded CCS lengths and SNRs before decoding any reads
+    metrics = load_zmw_metrics( raw_file )
+    passing = passing_ccs_mask( metrics, min_length, min_snr )
+    ccs_count = int( ccs_mask( metrics ).sum() )
+    pass_count = int( passing.sum() )
+
+    # Finally write the surviving CCS Fastqs to file
+    reader = BasH5Reader( raw_file )
+    try:
+        for hole_number in metrics.holeNumber[passing]:
+            ccs_read = reader[int(hole_number)].ccsRead
+            record = FastqRecord(ccs_read.readName,
+                                 ccs_read.basecalls(),
+                                 ccs_read.QualityValue())
+            writer.writeRecord( record )
+    finally:
+        reader.close()
+    return (ccs_count, pass_count)
+
+def add_counts( counts, raw_file, ccs_count, pass_count ):
+    movie = get_movie_name( raw_file )
+    movie_ccs, movie_pass = counts.get( movie, (0, 0) )
+    counts[movie] = (movie_ccs + ccs_count, movie_pass + pass_count)
+
+def log_counts( counts ):
+    for movie, (ccs_count, pass_count) in counts.iteritems():
+        log.info("Identified {0} CCS reads in {1}, of which {2} ({3}%) passed filter".format(ccs_count,
+                                                                                              movie,
+                                                                                              pass_count,
+                                                                                              percent(pass_count, ccs_count)))
+    ccs_total = sum( c for c, p in counts.itervalues() )
+    pass_total = sum( p for c, p in counts.itervalues() )
     log.info('Found a total of {0} CCS reads, of which {1} ({2}%) passed filter'.format(ccs_total,
                                                                                          pass_total,
-                                                                                         percentage))
+                                                                                         percent(pass_total, ccs_total)))
+
+def percent( count, total ):
+    if total == 0:
+        return 0.0
+    return round(100.0*count/total)
 
 if __name__ == '__main__':
     import sys
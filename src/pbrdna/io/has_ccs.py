@@ -2,41 +2,119 @@
 
 __author__ = 'bbowman@pacificbiosciences.com'
 
+import os
+import json
 import logging
-from pbcore.io.BasH5IO import BasH5Collection
-from pbrdna.utils import is_fasta, is_fastq, is_bash5, is_fofn
+
+import h5py
+import numpy as np
+
+from pbrdna.io.zmw_metrics import h5_part_files, cached_zmw_metrics, SEQUENCING_STATUS
+from pbrdna.utils import is_fasta, is_fastq, is_bash5, is_fofn, read_raw_data_files
 
 log = logging.getLogger(__name__)
 
-def file_has_ccs( filename ):
+CACHE_FILE = 'has_ccs.cache'
+
+# Probe results keyed on absolute path, stored as (mtime, has_ccs)
+probe_cache = {}
+
+def file_has_ccs( filename, cache_file=None ):
     if is_fasta( filename ) or is_fastq( filename ):
         return True
     elif is_bash5( filename ) or is_fofn( filename ):
-        return h5_has_ccs( filename )
+        return h5_has_ccs( filename, cache_file )
     else:
         msg = "Unrecognized file-type"
         log.error( msg )
         raise TypeError( msg )
 
-def h5_has_ccs( filename ):
+def h5_has_ccs( filename, cache_file=None ):
     """
     Check if a given input file has CCS Data
     """
-    collection = BasH5Collection( filename )
-    for movie in collection.movieNames:
-        log.info('Testing movie "%s" for the presence of CCS data')
-        # Make sure the movie has valid sequencing data
-        if len(collection[movie].sequencingZmws) < 1:
-            msg = 'Movie "%s" has no valid sequencing ZMWs' % movie
-            log.error( msg )
-            raise ValueError( msg )
-        # Test a random ZMW to see if the movie has CCS data
-        test_zmw = collection[movie].sequencingZmws[0]
-        try:
-            collection[movie][test_zmw].ccsRead
-        except ValueError:
-            log.info('Movie "%s" has no CCS data' % movie)
-            return False
-        log.info('Movie "%s" has valid CCS data' % movie)
+    load_probe_cache( cache_file )
+    try:
+        for raw_file in read_raw_data_files( filename ):
+            if not cached_has_ccs( raw_file ):
+                log.info('"%s" has no CCS data' % raw_file)
+                return False
+            log.info('"%s" has valid CCS data' % raw_file)
+    finally:
+        save_probe_cache( cache_file )
     log.info('All supplied sequencing movies have valid CCS data\n')
-    return True
\ No newline at end of file
+    return True
+
+def cached_has_ccs( filename ):
+    path = os.path.abspath( filename )
+    mtime = os.path.getmtime( path )
+    try:
+        cached_mtime, has_ccs = probe_cache[path]
+        if cached_mtime == mtime:
+            return has_ccs
+    except KeyError:
+        pass
+    metrics = cached_zmw_metrics( path )
+    if metrics is None:
+        has_ccs = probe_ccs( path )
+    else:
+        has_ccs = metrics_have_ccs( path, metrics )
+    probe_cache[path] = (mtime, has_ccs)
+    return has_ccs
+
+def probe_ccs( filename ):
+    """
+    Read just the hole status and CCS read lengths of a BasH5 or BaxH5
+    file, without creating any ZMW objects
+    """
+    log.info('Testing "%s" for the presence of CCS data' % filename)
+    is_sequencing = []
+    ccs_length = []
+    for part in h5_part_files( filename ):
+        with h5py.File( part, 'r' ) as handle:
+            hole_status = handle['PulseData/BaseCalls/ZMW/HoleStatus'][:]
+            is_sequencing.append( hole_status == SEQUENCING_STATUS )
+            if 'PulseData/ConsensusBasecalls' in handle:
+                ccs_length.append( handle['PulseData/ConsensusBasecalls/ZMW/NumEvent'][:] )
+            else:
+                ccs_length.append( np.zeros( len(hole_status), dtype=np.int32 ) )
+    return movie_has_ccs( filename, np.concatenate( is_sequencing ),
+                                    np.concatenate( ccs_length ) )
+
+def metrics_have_ccs( filename, metrics ):
+    """
+    Answer the probe from a file's cached ZMW metrics instead of its HDF5 data
+    """
+    return movie_has_ccs( filename, metrics.isSequencing, metrics.ccsLength )
+
+def movie_has_ccs( filename, is_sequencing, ccs_length ):
+    """
+    The probe and the cached metrics share this one test: a movie has
+    CCS data if any of its sequencing ZMWs produced a CCS read
+    """
+    # Make sure the movie has valid sequencing data
+    if not is_sequencing.any():
+        msg = '"%s" has no valid sequencing ZMWs' % filename
+        log.error( msg )
+        raise ValueError( msg )
+    return bool( (is_sequencing & (ccs_length > 0)).any() )
+
+def load_probe_cache( cache_file ):
+    if cache_file is None or not os.path.exists( cache_file ):
+        return
+    try:
+        with open( cache_file ) as handle:
+            for path, (mtime, has_ccs) in json.load( handle ).iteritems():
+                probe_cache.setdefault( path, (mtime, has_ccs) )
+    except ValueError:
+        log.warn('Ignoring unreadable CCS probe cache "%s"' % cache_file)
+
+def save_probe_cache( cache_file ):
+    if cache_file is None:
+        return
+    # Never let a failed save mask the result of the probe itself
+    try:
+        with open( cache_file, 'w' ) as handle:
+            json.dump( probe_cache, handle )
+    except (IOError, OSError):
+        log.warn('Unable to save the CCS probe cache "%s"' % cache_file)
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+
+__author__ = 'bbowman@pacificbiosciences.com'
+
+import os
+import logging
+
+from zipfile import BadZipfile
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+def file_stamp( filename ):
+    """
+    The modification time and size of a file, which a sidecar must
+    match to be considered current
+    """
+    stat = os.stat( filename )
+    return np.array( [stat.st_mtime, stat.st_size] )
+
+def load_sidecar( sidecar_file, source_file ):
+    """
+    Return the arrays of a NumPy sidecar file as a dictionary, or None if
+    it is missing, unreadable or out of date with its source file
+    """
+    if not os.path.exists( sidecar_file ):
+        return None
+    try:
+        with np.load( sidecar_file ) as sidecar:
+            if not np.array_equal( sidecar['stamp'], file_stamp( source_file ) ):
+                return None
+            return dict( (key, sidecar[key]) for key in sidecar.files if key != 'stamp' )
+    except (IOError, KeyError, ValueError, BadZipfile):
+        log.warn('Ignoring unreadable sidecar file "%s"' % sidecar_file)
+        return None
+
+def save_sidecar( sidecar_file, source_file, **arrays ):
+    """
+    Save arrays to a NumPy sidecar file stamped with its source file,
+    returning None instead of failing if the location isn't writable
+    """
+    # Write to a temporary file first so readers never see partial sidecars
+    temp_file = '%s.%s.tmp.npz' % (sidecar_file, os.getpid())
+    try:
+        np.savez( temp_file, stamp=file_stamp( source_file ), **arrays )
+        os.rename( temp_file, sidecar_file )
+    except (IOError, OSError):
+        if os.path.exists( temp_file ):
+            os.remove( temp_file )
+        return None
+    return sidecar_file
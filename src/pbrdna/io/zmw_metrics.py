@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+__author__ = 'bbowman@pacificbiosciences.com'
+
+import os
+import logging
+from collections import namedtuple
+
+import h5py
+import numpy as np
+
+from pbrdna.io.sidecar import load_sidecar, save_sidecar
+
+log = logging.getLogger(__name__)
+
+SEQUENCING_STATUS = 0
+UNKNOWN_PRODUCTIVITY = -1
+
+CACHE_SUFFIX = '.zmw_metrics.npz'
+
+ZmwMetrics = namedtuple('ZmwMetrics', ['holeNumber', 'isSequencing',
+                                       'hqRegionSnr', 'ccsLength',
+                                       'numPasses', 'productivity'])
+
+def h5_part_files( filename ):
+    """
+    Return the files holding the ZMW data of a BasH5 or BaxH5 file
+    """
+    with h5py.File( filename, 'r' ) as handle:
+        if 'MultiPart/Parts' not in handle:
+            return [filename]
+        parts = list( handle['MultiPart/Parts'][:] )
+    dirname = os.path.dirname( filename )
+    return [os.path.join( dirname, part ) for part in parts]
+
+def read_zmw_metrics( filename ):
+    """
+    Load the per-ZMW metrics of a BasH5 or BaxH5 file as NumPy arrays,
+    with one bulk read per HDF5 dataset
+    """
+    parts = [read_part_metrics( part ) for part in h5_part_files( filename )]
+    if len(parts) == 1:
+        return parts[0]
+    return ZmwMetrics( *[np.concatenate( column ) for column in zip(*parts)] )
+
+def read_part_metrics( filename ):
+    log.debug('Reading ZMW metrics from "%s"' % filename)
+    with h5py.File( filename, 'r' ) as handle:
+        zmws = handle['PulseData/BaseCalls/ZMW']
+        hole_number = zmws['HoleNumber'][:]
+        is_sequencing = zmws['HoleStatus'][:] == SEQUENCING_STATUS
+        zmw_metrics = handle['PulseData/BaseCalls/ZMWMetrics']
+        snr = zmw_metrics['HQRegionSNR'][:]
+        if 'Productivity' in zmw_metrics:
+            productivity = zmw_metrics['Productivity'][:].astype( np.int8 )
+        else:
+            productivity = np.empty( len(hole_number), dtype=np.int8 )
+            productivity.fill( UNKNOWN_PRODUCTIVITY )
+        if 'PulseData/ConsensusBasecalls' in handle:
+            ccs = handle['PulseData/ConsensusBasecalls']
+            ccs_length = ccs['ZMW/NumEvent'][:]
+            num_passes = ccs['Passes/NumPasses'][:]
+        else:
+            ccs_length = np.zeros( len(hole_number), dtype=np.int32 )
+            num_passes = np.zeros( len(hole_number), dtype=np.int32 )
+    return ZmwMetrics( hole_number, is_sequencing, snr, ccs_length,
+                       num_passes, productivity )
+
+def load_zmw_metrics( filename ):
+    """
+    Return the per-ZMW metrics of a BasH5 or BaxH5 file from its sidecar
+    cache, extracting and caching them first if needed
+    """
+    metrics = cached_zmw_metrics( filename )
+    if metrics is None:
+        metrics = read_zmw_metrics( filename )
+        save_zmw_metrics( filename, metrics )
+    return metrics
+
+def cache_locations( filename ):
+    """
+    Sidecar caches live next to the raw data if possible, and otherwise
+    in the current working directory
+    """
+    cache_name = os.path.basename( filename ) + CACHE_SUFFIX
+    return [os.path.join( os.path.dirname( os.path.abspath( filename ) ), cache_name ),
+            os.path.join( os.getcwd(), cache_name )]
+
+def cached_zmw_metrics( filename ):
+    """
+    Return the cached metrics of a file, or None if no current cache exists
+    """
+    for cache_file in cache_locations( filename ):
+        cache = load_sidecar( cache_file, filename )
+        if cache is None:
+            continue
+        try:
+            metrics = ZmwMetrics( *[cache[field] for field in ZmwMetrics._fields] )
+        except KeyError:
+            continue
+        log.debug('Using cached ZMW metrics from "%s"' % cache_file)
+        return metrics
+    return None
+
+def save_zmw_metrics( filename, metrics ):
+    for cache_file in cache_locations( filename ):
+        if save_sidecar( cache_file, filename, **metrics._asdict() ) is not None:
+            log.debug('Cached ZMW metrics in "%s"' % cache_file)
+            return cache_file
+    log.warn('Unable to cache the ZMW metrics for "%s"' % filename)
+    return None
+
+def ccs_mask( metrics ):
+    """
+    Mask of the sequencing ZMWs that produced a CCS read
+    """
+    return metrics.isSequencing & (metrics.ccsLength > 0)
+
+def passing_ccs_mask( metrics, min_length, min_snr ):
+    """
+    Mask of the CCS reads that pass the length and minimum-channel SNR filters
+    """
+    return ccs_mask( metrics ) & \
+           (metrics.ccsLength >= min_length) & \
+           (metrics.hqRegionSnr.min( axis=1 ) >= min_snr)
@@ -28,13 +28,31 @@
 #################################################################################$$
 
 import os
+import time
+import signal
+import logging
+import tempfile
 import subprocess
 
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
 from pbrdna.utils import which
+from pbrdna.resequence.dag_consensus import run_native_consensus
 
-SCRIPT_CHOICES = ['gcon.py']
+SCRIPT_CHOICES = ['gcon.py', 'native']
 MODE_CHOICES = ['r', 'd']
 
+NPROC = 1
+RETRIES = 1
+MIN_POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.5
+
+log = logging.getLogger(__name__)
+
+class GconTimeout(Exception):
+    pass
+
 class DagConRunner(object):
     """
     A tool for resequencing clusters of rDNA sequences with 
@@ -45,9 +63,19 @@ class DagConRunner(object):
     # Initialization Methods #
     ##########################
 
-    def __init__(self, script, mode=None):
+    def __init__(self, script, mode=None, nproc=NPROC, timeout=None,
+                                                       maxCpu=None,
+                                                       maxMemory=None,
+                                                       retries=RETRIES):
         self.script = script
         self.mode   = mode
+        self.nproc = nproc
+        # Limits of 0, as given on the command-line, mean no limit
+        self.timeout = timeout or None
+        self.maxCpu = maxCpu or None
+        self.maxMemory = maxMemory or None
+        self.retries = retries
+        self.pool = None
         self.validateSettings()
 
     def validateSettings(self):
@@ -63,46 +91,170 @@ class DagConRunner(object):
             except:
                 raise ValueError("Gcon.py runners must specify mode 'r' or 'd'")
         # Finally, if the script and options pass, find the absolute paths
-        self.executable = which( self.script )
+        if self.script == 'native':
+            self.executable = None
+        else:
+            self.executable = which( self.script )
+        self.setsid = which( 'setsid' )
 
     ####################
     # Instance Methods #
     ####################
 
+    def wrapCommand(self, command):
+        """
+        Apply the CPU time (seconds) and memory (MB) limits with the shell,
+        and start the process in its own session so a timeout can kill any
+        aligner it starts too.  Both are done by exec'd programs rather than
+        a preexec_fn, since running Python code between fork and exec in a
+        threaded process can deadlock
+        """
+        limits = []
+        if self.maxCpu is not None:
+            limits.append( 'ulimit -t %d' % self.maxCpu )
+        if self.maxMemory is not None:
+            limits.append( 'ulimit -v %d' % (self.maxMemory * 1024) )
+        if limits:
+            script = ' && '.join( limits + ['exec "$0" "$@"'] )
+            command = ['sh', '-c', script] + command
+        if self.setsid is not None:
+            command = [self.setsid] + command
+        return command
+
+    def killProcess(self, p):
+        if self.setsid is not None:
+            os.killpg( p.pid, signal.SIGKILL )
+        else:
+            p.kill()
+        p.wait()
+
+    def waitForProcess(self, p):
+        if self.timeout is None:
+            return p.wait()
+        deadline = time.time() + self.timeout
+        interval = MIN_POLL_INTERVAL
+        while p.poll() is None:
+            if time.time() > deadline:
+                self.killProcess( p )
+                raise GconTimeout()
+            time.sleep( interval )
+            interval = min( interval * 2, MAX_POLL_INTERVAL )
+        return p.returncode
+
     def runGcon(self, inputFile, outputFile, refFile=None, name=None):
         if outputFile is None:
-            outputFile = self.getOutputFileName( inputFile )
+            outputFile = self.getOutputFile( inputFile )
         if name is None:
-            path, filename =  os.path.split( inputFile )
-            filename, ext = os.path.splitext( filename ) 
-            name = filename + '_consensus'
+            name = self.getConsensusName( outputFile )
+        command = [self.executable, self.mode, inputFile]
         if self.mode == 'r':
             assert refFile is not None
-            p = subprocess.Popen( [self.executable, 
-                                   self.mode,
-                                   inputFile,
-                                   refFile,
-                                   '--cname', name,
-                                   '-o', outputFile] )
-            p.wait()
-        elif self.mode == 'd':
-            p = subprocess.Popen( [self.executable, 
-                                   self.mode,
-                                   inputFile,
-                                   '--cname', name,
-                                   '-o', outputFile] )
-            p.wait()
+            command.append( refFile )
+        command += ['--cname', name, '-o', outputFile]
+        # Stderr goes to a temporary file, since an undrained pipe
+        #    could block the process while we poll it
+        with tempfile.TemporaryFile() as stderrHandle:
+            p = subprocess.Popen( self.wrapCommand( command ),
+                                  stderr=stderrHandle )
+            try:
+                returnCode = self.waitForProcess( p )
+            finally:
+                stderrHandle.seek(0)
+                stderr = stderrHandle.read()
+        if returnCode != 0:
+            log.error('Gcon.py exited with code %s for "%s":\n%s' % (returnCode,
+                                                                     inputFile,
+                                                                     stderr))
+            # Don't leave a partial consensus to be picked up by later runs
+            if os.path.exists( outputFile ):
+                os.remove( outputFile )
+            raise subprocess.CalledProcessError( returnCode, ' '.join(command),
+                                                 output=stderr )
+        elif stderr:
+            log.debug('Gcon.py stderr for "%s":\n%s' % (inputFile, stderr))
         return outputFile
 
+    def runWithRetries(self, inputFile, outputFile, refFile=None):
+        """
+        Run Gcon.py, retrying failures, and return the consensus file or
+        None if it failed or timed out and the cluster should be represented
+        by its reference instead
+        """
+        for attempt in range( self.retries + 1 ):
+            timedOut = False
+            try:
+                return self.runGcon( inputFile, outputFile, refFile )
+            except GconTimeout:
+                log.warn('Gcon.py timed out after %ss on "%s"' % (self.timeout, inputFile))
+                timedOut = True
+            except subprocess.CalledProcessError:
+                pass
+            if os.path.exists( outputFile ):
+                os.remove( outputFile )
+            # Gcon.py is deterministic, so a retry would only time out again
+            if timedOut:
+                break
+        # Without a consensus, a cluster can still be represented by its reference
+        if refFile is None:
+            raise ValueError('Gcon.py failed for "%s" after %s attempts' % (inputFile,
+                                                                          attempt + 1))
+        log.warn('Gcon.py failed for "%s", using its reference instead' % inputFile)
+        return None
+
+    def submit(self, inputFile, refFile=None, outputFile=None):
+        """
+        Queue a consensus job on the runner's pool of nproc workers, returning
+        an AsyncResult whose get() gives the consensus file
+        """
+        if outputFile is None:
+            outputFile = self.getOutputFile( inputFile )
+        if self.pool is None:
+            self.pool = self.createPool()
+        if self.script == 'native':
+            # Only module-level functions can be sent to worker processes
+            return self.pool.apply_async( native_consensus_job,
+                                          (inputFile, outputFile, refFile,
+                                           self.getConsensusName( outputFile )) )
+        return self.pool.apply_async( self, (inputFile, refFile, outputFile) )
+
+    def createPool(self):
+        # Native consensus is CPU-bound Python, so it needs processes
+        #    rather than threads to run in parallel
+        if self.script == 'native':
+            return Pool( max(1, self.nproc) )
+        return ThreadPool( max(1, self.nproc) )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def getConsensusName(self, outputFile):
+        path, filename =  os.path.split( outputFile )
+        filename, ext = os.path.splitext( filename )
+        return filename
+
     def getOutputFile(self, inputFile):
         path, filename = os.path.split( inputFile )
         root, ext = os.path.splitext( filename )
         outputFile = root + '_consensus.fa'
         return os.path.join( path, outputFile )
 
-    def __call__(self, inputFile, refFile=None):
-        outputFile = self.getOutputFile( inputFile )
+    def __call__(self, inputFile, refFile=None, outputFile=None):
+        if outputFile is None:
+            outputFile = self.getOutputFile( inputFile )
         if os.path.exists( outputFile ):
             return outputFile
         elif self.script == 'gcon.py':
-            return self.runGcon( inputFile, outputFile, refFile )
+            return self.runWithRetries( inputFile, outputFile, refFile )
+        elif self.script == 'native':
+            return native_consensus_job( inputFile, outputFile, refFile,
+                                         self.getConsensusName( outputFile ) )
+
+def native_consensus_job( inputFile, outputFile, refFile, name ):
+    if os.path.exists( outputFile ):
+        return outputFile
+    if refFile is None:
+        raise ValueError('Native consensus requires a reference for "%s"' % inputFile)
+    return run_native_consensus( inputFile, refFile, outputFile, name )
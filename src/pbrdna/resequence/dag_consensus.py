@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+
+__author__ = 'bbowman@pacificbiosciences.com'
+
+import logging
+
+from collections import namedtuple, defaultdict
+from string import maketrans
+
+import numpy as np
+
+from pbcore.io.FastaIO import FastaReader, FastaRecord, FastaWriter
+
+MATCH = 1
+MISMATCH = -1
+GAP = -1
+BAND_WIDTH = 64
+KMER_SIZE = 8
+MIN_SEEDS = 3
+
+NEG_INF = -10 ** 8
+STOP, DIAG, UP, LEFT = range(4)
+
+BASES = 'ACGT-'
+BASE_CODES = dict( (base, code) for code, base in enumerate(BASES) )
+DELETION = BASE_CODES['-']
+DNA_TRANSLATOR = maketrans('ACGTN', 'TGCAN')
+
+ConsensusResult = namedtuple('ConsensusResult', ['sequence', 'support', 'numReads'])
+
+log = logging.getLogger(__name__)
+
+def run_native_consensus( input_file, reference_file, output_file, name ):
+    """
+    Write the consensus of a cluster of reads against its reference,
+    entirely in-process; a module-level function so it can be handed
+    to either a thread or a process pool
+    """
+    reads = [record.sequence.upper() for record in FastaReader( input_file )]
+    reference = iter( FastaReader( reference_file ) ).next().sequence.upper()
+    result = dag_consensus( reads, reference )
+    log.debug('Consensus of %s reads for "%s"' % (result.numReads, input_file))
+    header = '%s\tsupport=%.3f' % (name, result.support.mean() if len(result.support) else 0.0)
+    with FastaWriter( output_file ) as writer:
+        writer.writeRecord( FastaRecord( header, result.sequence ) )
+    return output_file
+
+def reverse_complement( sequence ):
+    return sequence.translate( DNA_TRANSLATOR )[::-1]
+
+def dag_consensus( reads, reference ):
+    """
+    Align each read to the reference and call a consensus from the DAG of
+    the reference backbone plus the insertion branches seen in the reads,
+    returning the sequence with the fraction of reads supporting each base
+    """
+    referenceKmers = index_kmers( reference )
+    refLength = len(reference)
+    votes = np.zeros( (refLength, len(BASES)), dtype=np.int32 )
+    spanStarts = np.zeros( refLength + 2, dtype=np.int32 )
+    insertions = defaultdict( lambda: defaultdict(int) )
+    numReads = 0
+    for read in reads:
+        oriented = orient_read( read, reference, referenceKmers )
+        if oriented is None:
+            continue
+        read, offset = oriented
+        alignment = align_to_reference( read, reference, offset )
+        add_alignment_votes( alignment, votes, spanStarts, insertions )
+        numReads += 1
+    # Insertion slot k lies between reference bases k-1 and k, and is only
+    #    covered by reads that span both of them
+    slotCoverage = np.cumsum( spanStarts )[:refLength+1]
+    return call_consensus( reference, votes, slotCoverage, insertions, numReads )
+
+def index_kmers( sequence, k=KMER_SIZE ):
+    kmers = {}
+    for i in xrange( len(sequence) - k + 1 ):
+        kmers.setdefault( sequence[i:i+k], i )
+    return kmers
+
+def seed_diagonals( read, referenceKmers, k=KMER_SIZE ):
+    diagonals = []
+    for i in xrange( len(read) - k + 1 ):
+        j = referenceKmers.get( read[i:i+k] )
+        if j is not None:
+            diagonals.append( j - i )
+    return diagonals
+
+def orient_read( read, reference, referenceKmers ):
+    """
+    Pick the strand of a read sharing the most k-mers with the reference,
+    and the diagonal to centre its alignment band on
+    """
+    forward = seed_diagonals( read, referenceKmers )
+    reverse = seed_diagonals( reverse_complement( read ), referenceKmers )
+    if len(reverse) > len(forward):
+        read, forward = reverse_complement( read ), reverse
+    if len(forward) < MIN_SEEDS:
+        return None
+    return read, int(np.median( forward ))
+
+def align_to_reference( read, reference, offset, band=BAND_WIDTH ):
+    """
+    Banded overlap alignment of a read (rows) against the reference
+    (columns) with linear gap costs, free end gaps on both sequences and
+    the band centred on the diagonal j = i + offset.  Each row's left gaps
+    are resolved at once with a running maximum, which linear gap costs
+    allow, so only the rows themselves are iterated in Python.
+    """
+    n, m = len(read), len(reference)
+    readCodes = np.frombuffer( read, dtype=np.uint8 )
+    refCodes = np.frombuffer( reference, dtype=np.uint8 )
+    columns = np.arange( m + 1, dtype=np.int32 )
+    pointers = np.zeros( (n+1, m+1), dtype=np.int8 )
+    previous = np.empty( m + 1, dtype=np.int32 )
+    current = np.empty( m + 1, dtype=np.int32 )
+    lastColumn = np.empty( n + 1, dtype=np.int32 )
+
+    # Reference bases before the read starts are free
+    previous.fill( NEG_INF )
+    lo, hi = max(0, offset - band), min(m, offset + band)
+    previous[lo:hi+1] = 0
+    lastColumn[0] = previous[m]
+    for i in xrange( 1, n + 1 ):
+        current.fill( NEG_INF )
+        lo, hi = max(0, i + offset - band), min(m, i + offset + band)
+        if lo <= hi:
+            scores = np.empty( hi - lo + 1, dtype=np.int32 )
+            moves = np.empty( hi - lo + 1, dtype=np.int8 )
+            first = max(lo, 1)
+            matches = refCodes[first-1:hi] == readCodes[i-1]
+            diagonal = previous[first-1:hi] + np.where( matches, MATCH, MISMATCH )
+            up = previous[first:hi+1] + GAP
+            scores[first-lo:] = np.maximum( diagonal, up )
+            moves[first-lo:] = np.where( diagonal >= up, DIAG, UP )
+            # Read bases before the reference starts are free too
+            if lo == 0:
+                scores[0] = 0
+                moves[0] = STOP
+            # Left moves: H[j] = max over k <= j of D[k] + GAP * (j - k)
+            gapCost = GAP * columns[lo:hi+1]
+            best = np.maximum.accumulate( scores - gapCost ) + gapCost
+            moves[best > scores] = LEFT
+            current[lo:hi+1] = best
+            pointers[i, lo:hi+1] = moves
+        lastColumn[i] = current[m]
+        previous, current = current, previous
+
+    # The alignment may end on the last row or the last column
+    endColumn = int(np.argmax( previous ))
+    endRow = int(np.argmax( lastColumn ))
+    if lastColumn[endRow] > previous[endColumn]:
+        i, j = endRow, m
+    else:
+        i, j = n, endColumn
+    return trace_alignment( read, pointers, i, j )
+
+def trace_alignment( read, pointers, i, j ):
+    """
+    Walk the traceback from (i, j), returning the aligned read base (or
+    deletion) for each covered reference position, the insertions keyed
+    by slot, and the covered reference span
+    """
+    refEnd = j
+    aligned = []
+    insertions = defaultdict( list )
+    while i > 0 and j > 0:
+        move = pointers[i, j]
+        if move == DIAG:
+            aligned.append( read[i-1] )
+            i, j = i - 1, j - 1
+        elif move == UP:
+            insertions[j].append( read[i-1] )
+            i -= 1
+        elif move == LEFT:
+            aligned.append( '-' )
+            j -= 1
+        else:
+            break
+    aligned.reverse()
+    insertions = dict( (slot, ''.join( reversed( bases ) ))
+                       for slot, bases in insertions.iteritems() )
+    return j, refEnd, aligned, insertions
+
+def add_alignment_votes( alignment, votes, spanStarts, insertions ):
+    refStart, refEnd, aligned, readInsertions = alignment
+    for position, base in enumerate( aligned, refStart ):
+        code = BASE_CODES.get( base )
+        if code is not None:
+            votes[position, code] += 1
+    spanStarts[refStart+1] += 1
+    spanStarts[refEnd] -= 1
+    # Bases hanging off either end of the span are overhang, not insertions
+    for slot, inserted in readInsertions.iteritems():
+        if refStart < slot < refEnd:
+            insertions[slot][inserted] += 1
+
+def call_consensus( reference, votes, slotCoverage, insertions, numReads ):
+    """
+    Take the heaviest path through the DAG: each insertion branch carried
+    by a majority of the reads spanning it, and the majority base (or
+    deletion) at each backbone position
+    """
+    sequence = []
+    support = []
+    # Ties between backbone calls go to the reference base
+    tieBreak = np.zeros( votes.shape, dtype=np.float64 )
+    for position, base in enumerate( reference ):
+        if base in BASE_CODES:
+            tieBreak[position, BASE_CODES[base]] = 0.5
+    calls = np.argmax( votes + tieBreak, axis=1 )
+    depth = votes.sum( axis=1 )
+    for position in xrange( len(reference) + 1 ):
+        branches = insertions.get( position )
+        if branches:
+            inserted, count = max( branches.iteritems(), key=lambda item: (item[1], item[0]) )
+            if 2 * count > slotCoverage[position]:
+                sequence.append( inserted )
+                support += [float(count) / slotCoverage[position]] * len(inserted)
+        if position == len(reference):
+            break
+        if depth[position] == 0:
+            continue
+        call = calls[position]
+        if call != DELETION:
+            sequence.append( BASES[call] )
+            support.append( float(votes[position, call]) / depth[position] )
+    return ConsensusResult( ''.join(sequence), np.array( support ), numReads )
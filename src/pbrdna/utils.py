@@ -1,5 +1,6 @@
 import os
 import sys
+import shutil
 import logging
 from collections import namedtuple
 
@@ -11,6 +12,8 @@ BlasrM1 = namedtuple('BlasrM1', ['qname', 'tname', 'qstrand', 'tstrand',
 
 log = logging.getLogger(__name__)
 
+COPY_BUFFER = 16 * 1024 * 1024
+
 def write_dummy_file( filename ):
     with open(filename, 'w') as handle:
         handle.write('DONE')
@@ -38,6 +41,33 @@ def is_bash5( filename ):
 def is_fofn( filename ):
     return filename.endswith('.fofn')
 
+def read_fofn( fofn_file ):
+    filenames = []
+    with open( fofn_file ) as handle:
+        for line in handle:
+            filename = line.strip()
+            if filename:
+                filenames.append( filename )
+    return filenames
+
+def read_raw_data_files( input_file ):
+    """
+    Return the list of BasH5/BaxH5 files referenced by an input file
+    """
+    if is_fofn( input_file ):
+        filenames = read_fofn( input_file )
+    else:
+        filenames = [input_file]
+    for filename in filenames:
+        if not is_bash5( filename ):
+            msg = '"%s" is not a BasH5 or BaxH5 file!' % filename
+            log.error( msg )
+            raise ValueError( msg )
+    return filenames
+
+def get_movie_name( filename ):
+    return os.path.basename( filename ).split('.')[0]
+
 def file_exists( filename ):
     return os.path.exists( filename ) and os.path.getsize( filename ) > 0
 
@@ -64,6 +94,18 @@ def get_output_name( input_file, output_type ):
     root, ext = os.path.splitext( input_file )
     return '{0}.{1}'.format(root, output_type)
 
+def merge_files( filenames, output_file, remove=False ):
+    """
+    Concatenate a list of files in order, optionally deleting them
+    """
+    with open( output_file, 'wb' ) as output:
+        for filename in filenames:
+            with open( filename, 'rb' ) as handle:
+                shutil.copyfileobj( handle, output, COPY_BUFFER )
+            if remove:
+                os.remove( filename )
+    return output_file
+
 def return_empty():
     return []
 
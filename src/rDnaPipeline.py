@@ -6,7 +6,7 @@ import shutil
 
 from pbrdna.log import initialize_logger
 from pbrdna.arguments import args, parse_args
-from pbrdna.io.has_ccs import file_has_ccs
+from pbrdna.io.has_ccs import file_has_ccs, CACHE_FILE
 from pbrdna.io.extract_ccs import extract_ccs
 from pbrdna.io.MothurIO import SummaryReader
 from pbrdna.fasta.utils import copy_fasta_list
@@ -19,6 +19,7 @@ from pbrdna.cluster.generate import generate_consensus_files, generate_reference
 from pbrdna.cluster.select import select_consensus_files, select_reference_files
 from pbrdna.cluster.clean_consensus import clean_consensus_outputs
 from pbrdna.cluster.names import create_name_file
+from pbrdna.cluster.members import members_file_for
 from pbrdna.resequence.DagConTools import DagConRunner
 from pbrdna.utils import (validate_executable,
                           create_directory,
@@ -58,7 +59,10 @@ class rDnaPipeline( object ):
         self.step_list = self.calculate_steps()
 
         if self.enable_consensus:
-            self.consensusTool = DagConRunner('gcon.py', 'r')
+            self.consensusTool = DagConRunner(self.consensus_tool, 'r', nproc=self.nproc,
+                                              timeout=self.consensus_timeout,
+                                              maxCpu=self.consensus_max_cpu,
+                                              maxMemory=self.consensus_max_memory)
 
         # Searching for Mothur executable, and set the Mothur Process counter
         self.mothur = validate_executable( self.mothur )
@@ -163,8 +167,10 @@ class rDnaPipeline( object ):
                                          suffix='fastq' )
         if self.output_files_exist(output_file=outputFile):
             return outputFile
-        elif file_has_ccs( inputFile ):
-            extract_ccs(inputFile, outputFile, self.raw_data)
+        elif file_has_ccs( inputFile, cache_file=CACHE_FILE ):
+            extract_ccs( inputFile, outputFile, min_length=self.min_length,
+                                                min_snr=self.min_snr,
+                                                nproc=self.nproc )
         else:
             msg = 'Raw data file has no CCS data!'
             log.error( msg )
@@ -178,7 +184,8 @@ class rDnaPipeline( object ):
                                          suffix='filter.fastq' )
         if self.output_files_exist(output_file=outputFile):
             return outputFile
-        quality_filter( fastqFile, outputFile, min_accuracy=self.min_accuracy )
+        quality_filter( fastqFile, outputFile, min_accuracy=self.min_accuracy,
+                                               nproc=self.nproc )
         self.process_cleanup(output_file=outputFile)
         return outputFile
 
@@ -406,7 +413,8 @@ class rDnaPipeline( object ):
                                         suffix='consensus')
         if self.output_files_exist(output_file=output_file):
             return output_file
-        generate_consensus_files( cluster_list_file, self.consensusTool, output_file )
+        generate_consensus_files( cluster_list_file, self.consensusTool, output_file,
+                                  max_depth=self.max_consensus_depth )
         self.process_cleanup(output_file=output_file)
         return output_file
 
@@ -482,7 +490,11 @@ class rDnaPipeline( object ):
                                         suffix='names' )
         if self.output_files_exist(output_file=outputFile):
             return outputFile
-        create_name_file( consensusFile, selectedFile, outputFile )
+        # Build the names from the cluster membership table when there is one
+        membersFile = members_file_for( consensusFile )
+        if not os.path.exists( membersFile ):
+            membersFile = None
+        create_name_file( consensusFile, selectedFile, outputFile, membersFile )
         self.process_cleanup(output_file=outputFile)
         return outputFile
 